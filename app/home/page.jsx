@@ -140,9 +140,9 @@ function extractCardData(card, email = null, productName = null, flag = true) {
 }
 
 /**
- * Reads and parses SSE stream from response, calling callbacks on logs/result
+ * Reads and parses SSE stream from response, calling callbacks on logs/token/result
  */
-async function readSSEStreamRealtime(response, { onLogs, onResult }) {
+async function readSSEStreamRealtime(response, { onLogs, onToken, onResult }) {
   const decoder = new TextDecoder();
   let buffer = "";
   let done = false;
@@ -173,6 +173,13 @@ async function readSSEStreamRealtime(response, { onLogs, onResult }) {
             onLogs(dataStr);
           }
         }
+        if (eventType === "token" && onToken) {
+          try {
+            onToken(JSON.parse(dataStr));
+          } catch {
+            onToken(dataStr);
+          }
+        }
         if (eventType === "result" && onResult) {
           resultReceived = true;
           let parsed;
@@ -548,6 +555,8 @@ export default function MainPage() {
         setSideInput("");
         return;
       }
+      // Final answer text as it is generated, shown until the result arrives.
+      let streamed = "";
       await readSSEStreamRealtime(response, {
         onLogs: (log) => {
           setSideLogs((prev) => ({
@@ -555,7 +564,18 @@ export default function MainPage() {
             [msgIdx]: [...(prev[msgIdx] || []), log],
           }));
         },
+        onToken: (text) => {
+          streamed += text;
+          setSideTypingIdx(msgIdx);
+          setSideTypingChunks([]);
+          setSideTypingCurrentChunk(streamed);
+        },
         onResult: (data) => {
+          if (streamed) {
+            setSideTypingIdx(-1);
+            setSideTypingChunks([]);
+            setSideTypingCurrentChunk("");
+          }
           // Always display the final_response if present for both query types
           let textToShow = "";
           if (
@@ -609,7 +629,14 @@ export default function MainPage() {
                 setSideTypingCurrentChunk("");
               }
             }
-            animateChunk();
+            if (streamed) {
+              // The answer was already shown token by token; no need to type it out again.
+              setSideMessages((prev) =>
+                prev.map((msg, mi) => (mi === msgIdx ? { ...msg, chunks: all } : msg))
+              );
+            } else {
+              animateChunk();
+            }
           } else {
             // For other types, display the final_response if exists
             if (
@@ -1,5 +1,135 @@
 export const config = { api: { bodyParser: false }, runtime: "nodejs" };
 
+// Backend SSE format: progress events are relayed as "logs", answer tokens as "token" as
+// soon as they are generated, then the final "result" or "error".
+async function relayEvents(response, res) {
+    const decoder = new TextDecoder();
+    const reader = response.body.getReader();
+    let buffer = "";
+    let finished = false;
+
+    const forward = (block) => {
+        let event = null;
+        const data = [];
+        for (const line of block.split(/\r?\n/)) {
+            if (line.startsWith("event: ")) event = line.slice("event: ".length);
+            else if (line.startsWith("data: ")) data.push(line.slice("data: ".length));
+        }
+        if (!event || !data.length) return;
+        let payload;
+        try {
+            payload = JSON.parse(data.join("\n"));
+        } catch {
+            return;
+        }
+        if (event === "progress") {
+            res.write(`event: logs\ndata: ${JSON.stringify(payload.message)}\n\n`);
+        } else if (event === "token") {
+            res.write(`event: token\ndata: ${JSON.stringify(payload.text)}\n\n`);
+        } else if (event === "result" || event === "error") {
+            finished = true;
+            res.write(`event: ${event}\ndata: ${JSON.stringify(payload)}\n\n`);
+        }
+    };
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (value) buffer += decoder.decode(value, { stream: !done });
+        const blocks = buffer.split("\n\n");
+        buffer = blocks.pop();
+        blocks.forEach(forward);
+        if (done) break;
+    }
+    if (buffer.trim()) forward(buffer);
+    if (!finished) {
+        res.write(`event: error\ndata: ${JSON.stringify({ error: "No result returned from backend" })}\n\n`);
+    }
+    res.end();
+}
+
+// CLI text format (RAG_WORKER_MODE=subprocess): log lines, then ===RESULT=== and the JSON result.
+async function relayText(response, res) {
+    const decoder = new TextDecoder();
+    const reader = response.body.getReader();
+
+    let logBuffer = "";
+    let resultBuffer = "";
+    let inResult = false;
+    const sep = "===RESULT===";
+
+    async function stream() {
+        while (true) {
+            const { value, done } = await reader.read();
+            if (value) {
+                const chunk = decoder.decode(value, { stream: !done });
+
+                // If not in result, keep looking for sep
+                if (!inResult) {
+                    logBuffer += chunk;
+                    let sepIdx = logBuffer.indexOf(sep);
+
+                    // If sep found, split logs/result
+                    if (sepIdx !== -1) {
+                        const logsPart = logBuffer.slice(0, sepIdx);
+                        // Emit any remaining logs by line
+                        logsPart.split(/\r?\n/).forEach((line) => {
+                            if (line.trim()) {
+                                console.log(JSON.stringify(line));
+                                res.write(`event: logs\ndata: ${JSON.stringify(line)}\n\n`);
+                            }
+                        });
+                        resultBuffer = logBuffer.slice(sepIdx + sep.length);
+                        inResult = true;
+                        logBuffer = "";
+                    } else {
+                        // Otherwise, stream logs line by line
+                        let lines = logBuffer.split(/\r?\n/);
+                        // Keep last line in buffer if not complete
+                        logBuffer = lines.pop();
+                        lines.forEach((line) => {
+                            if (line.trim()) {
+                                console.log(JSON.stringify(line));
+                                res.write(`event: logs\ndata: ${JSON.stringify(line)}\n\n`);
+                            }
+                        });
+                    }
+                } else {
+                    // After sep, everything is result
+                    resultBuffer += chunk;
+                }
+            }
+            if (done) {
+                // Flush remaining logs (before sep) if any
+                if (!inResult && logBuffer.trim()) {
+                    res.write(`event: logs\ndata: ${JSON.stringify(logBuffer.trim())}\n\n`);
+                }
+                // Emit result if found
+                if (inResult) {
+                    const resultPart = resultBuffer.trim();
+                    let result;
+                    if (!resultPart) {
+                        result = { error: "No result returned from backend", raw: resultPart };
+                    } else {
+                        try {
+                            result = JSON.parse(resultPart);
+                        } catch (e) {
+                            result = { error: "Failed to parse result JSON", raw: resultPart };
+                        }
+                    }
+                    console.log(JSON.stringify(result));
+                    res.write(`event: result\ndata: ${JSON.stringify(result)}\n\n`);
+                } else {
+                    // No result found
+                    res.write(`event: error\ndata: ${JSON.stringify({ error: "No result separator found" })}\n\n`);
+                }
+                res.end();
+                break;
+            }
+        }
+    }
+    await stream();
+}
+
 export default async function handler(req, res) {
     if (req.method !== "POST") {
         res.status(405).json({ message: "Method not allowed" });
@@ -30,12 +160,15 @@ export default async function handler(req, res) {
             headers: {
                 "Content-Type": "application/json",
                 "x-api-key": process.env.FASTAPI_API_KEY,
+                // The backend queues requests fairly per end client.
+                "x-forwarded-for": req.headers["x-forwarded-for"] || req.socket.remoteAddress || "",
             },
             body: JSON.stringify({
                 user_query: prompt,
                 type: Number(type),
                 latitude,
                 longitude,
+                stream: "sse",
             }),
         });
 
@@ -51,85 +184,11 @@ export default async function handler(req, res) {
             Connection: "keep-alive",
         });
 
-        const decoder = new TextDecoder();
-        const reader = response.body.getReader();
-
-        let logBuffer = "";
-        let resultBuffer = "";
-        let inResult = false;
-        const sep = "===RESULT===";
-
-        async function stream() {
-            while (true) {
-                const { value, done } = await reader.read();
-                if (value) {
-                    const chunk = decoder.decode(value, { stream: !done });
-
-                    // If not in result, keep looking for sep
-                    if (!inResult) {
-                        logBuffer += chunk;
-                        let sepIdx = logBuffer.indexOf(sep);
-
-                        // If sep found, split logs/result
-                        if (sepIdx !== -1) {
-                            const logsPart = logBuffer.slice(0, sepIdx);
-                            // Emit any remaining logs by line
-                            logsPart.split(/\r?\n/).forEach((line) => {
-                                if (line.trim()) {
-                                    console.log(JSON.stringify(line));
-                                    res.write(`event: logs\ndata: ${JSON.stringify(line)}\n\n`);
-                                }
-                            });
-                            resultBuffer = logBuffer.slice(sepIdx + sep.length);
-                            inResult = true;
-                            logBuffer = "";
-                        } else {
-                            // Otherwise, stream logs line by line
-                            let lines = logBuffer.split(/\r?\n/);
-                            // Keep last line in buffer if not complete
-                            logBuffer = lines.pop();
-                            lines.forEach((line) => {
-                                if (line.trim()) {
-                                    console.log(JSON.stringify(line));
-                                    res.write(`event: logs\ndata: ${JSON.stringify(line)}\n\n`);
-                                }
-                            });
-                        }
-                    } else {
-                        // After sep, everything is result
-                        resultBuffer += chunk;
-                    }
-                }
-                if (done) {
-                    // Flush remaining logs (before sep) if any
-                    if (!inResult && logBuffer.trim()) {
-                        res.write(`event: logs\ndata: ${JSON.stringify(logBuffer.trim())}\n\n`);
-                    }
-                    // Emit result if found
-                    if (inResult) {
-                        const resultPart = resultBuffer.trim();
-                        let result;
-                        if (!resultPart) {
-                            result = { error: "No result returned from backend", raw: resultPart };
-                        } else {
-                            try {
-                                result = JSON.parse(resultPart);
-                            } catch (e) {
-                                result = { error: "Failed to parse result JSON", raw: resultPart };
-                            }
-                        }
-                        console.log(JSON.stringify(result));
-                        res.write(`event: result\ndata: ${JSON.stringify(result)}\n\n`);
-                    } else {
-                        // No result found
-                        res.write(`event: error\ndata: ${JSON.stringify({ error: "No result separator found" })}\n\n`);
-                    }
-                    res.end();
-                    break;
-                }
-            }
+        if ((response.headers.get("content-type") || "").includes("text/event-stream")) {
+            await relayEvents(response, res);
+        } else {
+            await relayText(response, res);
         }
-        await stream();
     } catch (err) {
         console.error(err);
         if (!res.headersSent) {
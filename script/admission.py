@@ -0,0 +1,127 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+
+# Upper bounds (seconds) of the queue wait-time histogram buckets.
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; `retry_after` is a hint in whole seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Concurrency limit with a bounded, per-client fair wait queue.
+
+    At most `max_concurrency` requests run at once. Others wait in a queue of at most
+    `max_queue` entries for up to `max_wait` seconds; anything beyond that is rejected
+    straight away. Waiters are kept per client key and freed slots are handed out round
+    robin across clients, so one busy client cannot starve the rest.
+    """
+
+    def __init__(self, max_concurrency=8, max_queue=32, max_wait=30.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.queued = 0
+        self._waiters = OrderedDict()  # client key -> deque of futures
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_count = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * len(WAIT_BUCKETS)
+        self._service_time = 5.0  # moving average of how long a slot is held
+
+    def retry_after(self):
+        return max(1, math.ceil(self._service_time * (self.queued + 1) / self.max_concurrency))
+
+    async def acquire(self, client):
+        """Wait for a slot. Returns a token to pass to `release`; raises AdmissionRejected."""
+        started = time.monotonic()
+        if self.in_flight < self.max_concurrency and not self.queued:
+            self.in_flight += 1
+            return self._admitted(started)
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected("queue full", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(client, deque()).append(future)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if not future.done():
+                self._forget(client, future)
+                self.timed_out += 1
+                raise AdmissionRejected("queue wait deadline exceeded", self.retry_after())
+        except asyncio.CancelledError:
+            if future.done():
+                # A slot was handed to us as we were cancelled; give it to the next waiter.
+                self.release(self._admitted(started))
+            else:
+                self._forget(client, future)
+            raise
+        return self._admitted(started)
+
+    def release(self, token):
+        held = time.monotonic() - token
+        self._service_time = 0.9 * self._service_time + 0.1 * held
+        while self._waiters:
+            client, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                self._waiters.move_to_end(client)
+            else:
+                del self._waiters[client]
+            if not future.done():
+                # The slot passes straight to the waiter, so in_flight is unchanged.
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def _forget(self, client, future):
+        future.cancel()
+        waiters = self._waiters.get(client)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self.queued -= 1
+            if not waiters:
+                del self._waiters[client]
+
+    def _admitted(self, started):
+        now = time.monotonic()
+        waited = now - started
+        self.admitted += 1
+        self.wait_count += 1
+        self.wait_sum += waited
+        self.wait_max = max(self.wait_max, waited)
+        for i, bound in enumerate(WAIT_BUCKETS):
+            if waited <= bound:
+                self.wait_buckets[i] += 1
+                break
+        return now
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "queued_clients": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_seconds_avg": self.wait_sum / self.wait_count if self.wait_count else 0.0,
+            "wait_seconds_max": self.wait_max,
+            "wait_seconds_buckets": dict(zip(map(str, WAIT_BUCKETS), self.wait_buckets)),
+        }
@@ -0,0 +1,184 @@
+"""
+Approximate nearest neighbour index options for the FAISS vectorstore.
+
+`FAISS.load_local` gives an exact IndexFlat whose search cost grows linearly with the
+corpus. This module rebuilds a saved index as IVF, HNSW or IVF-PQ (trained on a sample
+of the stored vectors), loads indexes memory-mapped so several worker processes share
+one on-disk copy, and reports recall/latency of each setting against the flat index.
+
+    python ann_index.py build --kind ivfpq --nlist 4096 --pq-m 32 --out faiss_index_ivfpq
+    python ann_index.py report --index faiss_index --kind hnsw
+"""
+import argparse
+import json
+import os
+import pickle
+import shutil
+import time
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from lexical_index import BM25Index
+
+INDEX_KINDS = ("flat", "ivf", "hnsw", "ivfpq")
+
+
+def index_factory_string(kind, dim, nlist=1024, hnsw_m=32, pq_m=16, pq_bits=8):
+    if kind == "flat":
+        return "Flat"
+    if kind == "ivf":
+        return f"IVF{nlist},Flat"
+    if kind == "hnsw":
+        return f"HNSW{hnsw_m},Flat"
+    if kind == "ivfpq":
+        if dim % pq_m:
+            raise ValueError(f"pq_m={pq_m} must divide the embedding dimension {dim}")
+        return f"IVF{nlist},PQ{pq_m}x{pq_bits}"
+    raise ValueError(f"Unknown index kind {kind!r}, expected one of {INDEX_KINDS}")
+
+
+def build_index(vectors, kind, metric=faiss.METRIC_L2, train_size=100000, seed=0, **params):
+    """Create an index of `kind`, train it on a random sample of `vectors` and add them all."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    index = faiss.index_factory(vectors.shape[1], index_factory_string(kind, vectors.shape[1], **params), metric)
+    if not index.is_trained:
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(len(vectors), size=min(train_size, len(vectors)), replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    return index
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """Apply query-time knobs; parameters that do not apply to the index type are ignored."""
+    space = faiss.ParameterSpace()
+    if nprobe is not None and faiss.try_extract_index_ivf(index) is not None:
+        space.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search is not None and "HNSW" in type(faiss.downcast_index(index)).__name__:
+        space.set_index_parameter(index, "efSearch", ef_search)
+
+
+def stored_vectors(index):
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def mmap_flags(index_path):
+    """
+    read_index flags that memory-map the stored vectors of `index_path`.
+
+    IO_FLAG_MMAP only maps the inverted lists of IVF indexes (fourcc "Iw.."); Flat and
+    HNSW indexes need IO_FLAG_MMAP_IFC, without which every process still holds its own
+    full copy. Older faiss builds lack that flag, and there only IVF kinds are shared.
+    """
+    with open(index_path, "rb") as f:
+        fourcc = f.read(4)
+    if fourcc.startswith(b"Iw") or not hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+
+
+def load_index(path, embeddings, mmap=True, nprobe=None, ef_search=None):
+    """
+    Load a vectorstore saved with `save_local`, optionally memory-mapping the index file.
+
+    A memory-mapped index is shared through the page cache by every process that opens
+    it, but it is read-only: write-back must be disabled for those processes.
+    """
+    index_path = os.path.join(path, "index.faiss")
+    index = faiss.read_index(index_path, mmap_flags(index_path) if mmap else 0)
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+def convert(args):
+    with open(os.path.join(args.index, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    flat = faiss.read_index(os.path.join(args.index, "index.faiss"))
+    started = time.time()
+    index = build_index(
+        stored_vectors(flat), args.kind, metric=flat.metric_type, train_size=args.train_size,
+        nlist=args.nlist, hnsw_m=args.hnsw_m, pq_m=args.pq_m, pq_bits=args.pq_bits,
+    )
+    os.makedirs(args.out, exist_ok=True)
+    faiss.write_index(index, os.path.join(args.out, "index.faiss"))
+    with open(os.path.join(args.out, "index.pkl"), "wb") as f:
+        pickle.dump((docstore, index_to_docstore_id), f)
+    lexical = os.path.join(args.index, BM25Index.FILENAME)
+    if os.path.exists(lexical):
+        shutil.copyfile(lexical, os.path.join(args.out, BM25Index.FILENAME))
+    print(f"---Built {args.kind} index over {index.ntotal} vectors in {time.time() - started:.1f}s -> {args.out}---", flush=True)
+
+
+def recall_report(flat, index, queries, k, settings):
+    """Recall@k of `index` against exact search on `flat`, with mean latency per query."""
+    _, truth = flat.search(queries, k)
+    rows = []
+    for setting in settings:
+        set_search_params(index, **setting)
+        started = time.perf_counter()
+        _, found = index.search(queries, k)
+        latency_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        recall = np.mean([len(set(t) & set(f)) / k for t, f in zip(truth, found)])
+        rows.append({**setting, "recall_at_k": round(float(recall), 4), "latency_ms": round(latency_ms, 4)})
+    return rows
+
+
+def report(args):
+    flat = faiss.read_index(os.path.join(args.index, "index.faiss"))
+    vectors = stored_vectors(flat)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)]
+    # Perturb the sampled vectors so queries are not exact copies of stored points.
+    queries = queries + rng.normal(scale=args.noise, size=queries.shape).astype(np.float32)
+
+    exact = faiss.IndexFlat(flat.d, flat.metric_type)
+    exact.add(vectors)
+    started = time.perf_counter()
+    exact.search(queries, args.k)
+    flat_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+    index = build_index(
+        vectors, args.kind, metric=flat.metric_type, train_size=args.train_size,
+        nlist=args.nlist, hnsw_m=args.hnsw_m, pq_m=args.pq_m, pq_bits=args.pq_bits,
+    )
+    if args.kind == "hnsw":
+        settings = [{"ef_search": ef} for ef in (16, 32, 64, 128, 256)]
+    else:
+        settings = [{"nprobe": n} for n in (1, 4, 16, 64, 256) if n <= args.nlist]
+    result = {
+        "kind": args.kind,
+        "vectors": int(flat.ntotal),
+        "k": args.k,
+        "flat_latency_ms": round(flat_ms, 4),
+        "settings": recall_report(exact, index, queries, args.k, settings),
+    }
+    print(json.dumps(result, indent=2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["build", "report"])
+    parser.add_argument("--index", default="faiss_index", help="saved flat index to read vectors from")
+    parser.add_argument("--out", default="faiss_index_ann")
+    parser.add_argument("--kind", choices=INDEX_KINDS, default="ivf")
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--pq-m", type=int, default=16)
+    parser.add_argument("--pq-bits", type=int, default=8)
+    parser.add_argument("--train-size", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--noise", type=float, default=0.01)
+    parser.add_argument("-k", type=int, default=4)
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        convert(args)
+    else:
+        report(args)
+
+
+if __name__ == "__main__":
+    main()
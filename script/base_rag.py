@@ -1,9 +1,35 @@
 import os
 import sys
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import json
+import re
 load_dotenv()
 
+# Per-request destination for pipeline events. The CLI leaves it unset and prints progress
+# lines to stdout; the API's in-process workers point it at the response stream. Events
+# are dicts: {"event": "progress", "node", "message"} or {"event": "token", "text"}.
+_progress_sink = contextvars.ContextVar("progress_sink", default=None)
+
+def log_progress(message, node=None):
+    sink = _progress_sink.get()
+    if sink is None:
+        print(message, flush=True)
+    else:
+        sink({"event": "progress", "node": node, "message": message})
+
+async def stream_tokens(chunks):
+    """Forward generated text chunks to the sink as token events and return the joined text."""
+    sink = _progress_sink.get()
+    parts = []
+    async for chunk in chunks:
+        parts.append(chunk)
+        if sink is not None:
+            sink({"event": "token", "text": chunk})
+    return "".join(parts)
+
 project_id = os.getenv("IBM_PROJECT_ID")
 api_key = os.getenv("WATSONX_API_KEY")
 tavily_api_key = os.getenv("TAVILY_API_KEY")
@@ -13,49 +39,202 @@ credentials = {
     "apikey": api_key
     }
 
-from langchain_community.vectorstores import FAISS
-from langchain_ibm import WatsonxEmbeddings, WatsonxLLM
-from ibm_watsonx_ai.metanames import GenTextParamsMetaNames as GenTextParamsMetaNames
-import os
-import pickle
-
-embeddings = WatsonxEmbeddings(
-    model_id='ibm/slate-125m-english-rtrvr',
-    apikey=credentials.get('apikey'),
-    url=credentials.get('url'),
-    project_id=project_id
-)
-
-faiss_index_path = "faiss_index"
+import functools
+import threading
+import tracing
+from tracing import traced
+from cache import AsyncSingleFlight, normalize_query, location_bucket
+
+# Nothing heavy happens at import time. The langchain / watsonx / FAISS / langgraph imports
+# and every client, index, cache, chain and graph below are built by the @lazy get_*
+# functions on first use, so the CLI can check its arguments and tooling can import this
+# module cheaply. Module attributes of the old names (base_rag.embeddings,
+# base_rag.knowledge_base, ...) resolve through the same functions; build() constructs
+# everything up front for long-running workers.
+_build_lock = threading.RLock()
+
+def lazy(build):
+    """Cache the result of a zero-argument builder; the first call constructs it under a lock."""
+    value = []
+    @functools.wraps(build)
+    def get():
+        if not value:
+            with _build_lock:
+                if not value:
+                    value.append(build())
+        return value[0]
+    get.built = lambda: bool(value)
+    return get
+
+# RAG_BACKEND=fake swaps watsonx and Tavily for the deterministic stand-ins in fakes.py
+# (used by bench.py); everything else in the pipeline runs unchanged.
+RAG_BACKEND = os.getenv("RAG_BACKEND", "watsonx")
+
+@lazy
+def get_clients():
+    # Rate limiting, retries and request deadlines for every remote call (see clients.py).
+    import clients
+    return clients
+
+def request_time_left():
+    """Seconds left of the current /ask request's deadline, None without one."""
+    # Deadlines are only ever set through clients.set_deadline, so none exist before it is imported.
+    clients = sys.modules.get("clients")
+    return clients.call_timeout(None) if clients is not None else None
+
+@lazy
+def get_watsonx():
+    # One pooled watsonx client for the LLM and the embeddings.
+    return get_clients().watsonx_client(credentials.get('url'), credentials.get('apikey'), project_id)
+
+@lazy
+def get_embeddings():
+    # Query embeddings from concurrent requests are coalesced into batched calls and cached.
+    from batching import BatchingEmbeddings
+    if RAG_BACKEND == "fake":
+        import fakes
+        inner = fakes.FakeEmbeddings()
+    else:
+        inner = get_clients().LimitedWatsonxEmbeddings(
+            model_id='ibm/slate-125m-english-rtrvr',
+            watsonx_client=get_watsonx(),
+            project_id=project_id
+        )
+    return BatchingEmbeddings(
+        inner,
+        max_batch=int(os.getenv("EMBED_BATCH_MAX", "32")),
+        max_delay=float(os.getenv("EMBED_BATCH_DELAY_MS", "5")) / 1000,
+        cache_size=int(os.getenv("EMBED_CACHE_SIZE", "10000")),
+        timeout=request_time_left,
+    )
 
-if os.path.exists(faiss_index_path):
-    vectorstore = FAISS.load_local(faiss_index_path, embeddings, allow_dangerous_deserialization=True)
-else:
+faiss_index_path = os.getenv("FAISS_INDEX_PATH", "faiss_index")
+
+# FAISS_MMAP=1 memory-maps the index (flat, or IVF/HNSW built with ann_index.py) so worker
+# processes share one on-disk copy (see ann_index.mmap_flags); nprobe / efSearch are
+# applied at load time.
+FAISS_MMAP = os.getenv("FAISS_MMAP", "0") == "1"
+
+def _int_env(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+@lazy
+def get_vectorstore():
+    from langchain_community.vectorstores import FAISS
+    embeddings = get_embeddings()
+    if os.path.exists(faiss_index_path) and FAISS_MMAP:
+        from ann_index import load_index
+        return load_index(faiss_index_path, embeddings, mmap=True, nprobe=_int_env("FAISS_NPROBE"), ef_search=_int_env("FAISS_EF_SEARCH"))
+    if os.path.exists(faiss_index_path):
+        from ann_index import set_search_params
+        vectorstore = FAISS.load_local(faiss_index_path, embeddings, allow_dangerous_deserialization=True)
+        set_search_params(vectorstore.index, nprobe=_int_env("FAISS_NPROBE"), ef_search=_int_env("FAISS_EF_SEARCH"))
+        return vectorstore
     vectorstore = FAISS.from_texts(["dummy"], embeddings)
     vectorstore.save_local(faiss_index_path)
+    return vectorstore
+
+# Web results are written back into the FAISS index so repeat topics are answered from
+# local retrieval. "graded" only keeps results the retrieval grader accepts (graded
+# asynchronously after the search, under the LLM rate limit), "all" keeps every new
+# result unvetted and "off" disables write-back. A memory-mapped index is read-only.
+KB_WRITEBACK = os.getenv("KB_WRITEBACK", "off" if FAISS_MMAP else "graded")
+# Write-backs in progress (grading or waiting for the writer thread); searches beyond
+# this are not written back.
+KB_WRITEBACK_QUEUE = int(os.getenv("KB_WRITEBACK_QUEUE", "32"))
+writeback_slots = threading.BoundedSemaphore(KB_WRITEBACK_QUEUE)
+writeback_tasks = set()  # strong references to running write-back tasks
+
+@lazy
+def get_knowledge_base():
+    from knowledge_base import IndexLock, KnowledgeBase
+    if KB_WRITEBACK != "off":
+        # Held (shared) until the process exits and taken before the index is loaded:
+        # ingest.py --merge refuses to run while we serve, and we wait for a running merge.
+        IndexLock(faiss_index_path).acquire()
+    return KnowledgeBase(
+        get_vectorstore(),
+        faiss_index_path,
+        get_embeddings(),
+        max_documents=int(os.getenv("KB_MAX_WEB_DOCUMENTS", "50000")),
+        save_interval=float(os.getenv("KB_SAVE_INTERVAL", "300")),
+        batch_size=int(os.getenv("KB_EMBED_BATCH_SIZE", "16")),
+    )
 
-from langchain.schema import Document
-retriever = vectorstore.as_retriever()
-
-from langchain_community.tools.tavily_search import TavilySearchResults
-web_search_tool = TavilySearchResults(tavily_api_key=tavily_api_key)
-
-llm = WatsonxLLM(
-    model_id = "meta-llama/llama-3-405b-instruct",
-    url=credentials.get("url"),
-    apikey=credentials.get("apikey"),
-    project_id=project_id,
-    params = {  GenTextParamsMetaNames.DECODING_METHOD: "greedy",
-                GenTextParamsMetaNames.MAX_NEW_TOKENS: 1000,
-                GenTextParamsMetaNames.TEMPERATURE: 0.7,
-                GenTextParamsMetaNames.MIN_NEW_TOKENS: 10})
+@lazy
+def get_writeback_pool():
+    # A single writer thread keeps index mutations serialized and off the request path.
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="kb-writeback")
+
+@lazy
+def get_retriever():
+    # Dense FAISS results fused with the BM25 index kept alongside it (reciprocal rank
+    # fusion), so product and brand names that the embedding model handles poorly still match.
+    return get_knowledge_base().as_retriever(k=int(os.getenv("RETRIEVER_K", "4")), fetch_k=int(os.getenv("RETRIEVER_FETCH_K", "20")))
+
+# Answers are cached per request ("final", keyed on query + type + location bucket) and
+# per decomposed sub-question ("sub"). Misses fall back to a semantic match on the
+# query embedding within the same type/location scope.
+ANSWER_CACHE_MODES = [m.strip() for m in os.getenv("ANSWER_CACHE_MODES", "final,sub").split(",") if m.strip()]
+LOCATION_BUCKET_DEGREES = float(os.getenv("LOCATION_BUCKET_DEGREES", "1.0"))
+
+@lazy
+def get_answer_cache():
+    from cache import SqliteCache, SemanticCache
+    return SemanticCache(
+        SqliteCache(
+            os.getenv("ANSWER_CACHE_PATH", "rag_cache.sqlite"),
+            "answers",
+            ttl=float(os.getenv("ANSWER_CACHE_TTL", "86400")),
+            max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000")),
+        ),
+        get_embeddings(),
+        threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.92")),
+    )
 
-from langchain.prompts import PromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.output_parsers import JsonOutputParser
+def record_cache_lookup(cache, hit):
+    tracing.annotate(**{f"{cache}_cache_hit": hit})
+    tracing.metrics.inc("rag_cache_lookups_total", cache=cache, result="hit" if hit else "miss")
+
+# Tavily results keyed on the exact constrained query; identical searches that are in
+# flight at the same time share one upstream call.
+@lazy
+def get_web_cache():
+    from cache import SqliteCache
+    return SqliteCache(
+        os.getenv("WEB_CACHE_PATH", "rag_cache.sqlite"),
+        "web_results",
+        ttl=float(os.getenv("WEB_CACHE_TTL", "21600")),
+        max_entries=int(os.getenv("WEB_CACHE_MAX_ENTRIES", "10000")),
+    )
 
-prompt = PromptTemplate(
-    template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>You are an assistant for environmental product questions, providing comprehensive answers about the environmental impacts of products, including their carbon footprint, water usage, waste generation, and other relevant factors. You should also suggest actionable steps to reduce environmental impact and provide citations for your information.
+web_search_flight = AsyncSingleFlight()
+
+@lazy
+def get_web_search_tool():
+    if RAG_BACKEND == "fake":
+        import fakes
+        return fakes.FakeSearch()
+    return get_clients().TavilySearch(tavily_api_key)
+
+@lazy
+def get_llm():
+    if RAG_BACKEND == "fake":
+        import fakes
+        return fakes.FakeLLM.from_env()
+    from ibm_watsonx_ai.metanames import GenTextParamsMetaNames
+    return get_clients().LimitedWatsonxLLM(
+        model_id = "meta-llama/llama-3-405b-instruct",
+        watsonx_client=get_watsonx(),
+        project_id=project_id,
+        params = {  GenTextParamsMetaNames.DECODING_METHOD: "greedy",
+                    GenTextParamsMetaNames.MAX_NEW_TOKENS: 1000,
+                    GenTextParamsMetaNames.TEMPERATURE: 0.7,
+                    GenTextParamsMetaNames.MIN_NEW_TOKENS: 10})
+
+# Prompt templates are kept as plain strings; get_chains() turns them into chains.
+rag_template = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>You are an assistant for environmental product questions, providing comprehensive answers about the environmental impacts of products, including their carbon footprint, water usage, waste generation, and other relevant factors. You should also suggest actionable steps to reduce environmental impact and provide citations for your information.
     {{Below is some context from different sources followed by a user's question. Please answer the question based on the context.
 
     Documents: {documents}}} <|eot_id|><|start_header_id|>user<|end_header_id|>
@@ -63,12 +242,9 @@ prompt = PromptTemplate(
     {{ Question: {question} }}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
 
     Answer:
-    """,
-    input_variables=["question", "documents"],
-)
+    """
 
-final_prompt = PromptTemplate(
-    template="""
+final_template = """
 
 <|begin_of_text|><|start_header_id|>system<|end_header_id|>
 
@@ -124,17 +300,9 @@ Latitude: {latitude}
 Longitude: {longitude}
 
 <|eot_id|><|start_header_id|>assistant<|end_header_id|>
-""",
-    input_variables=["question", "documents", "type", "latitude", "longitude"],
-)
-
+"""
 
-rag_chain = prompt | llm | StrOutputParser()
-
-final_rag_chain = final_prompt | llm 
-
-retrieval_prompt = PromptTemplate(
-    template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+retrieval_template = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
     You are a grader assessing relevance of a retrieved document to a user question. \n
     Here is the retrieved document: \n\n {document} \n\n
 
@@ -142,14 +310,9 @@ retrieval_prompt = PromptTemplate(
     Here is the user question: {question} \n
 
     Give a binary score 'yes' or 'no' to indicate whether the answer is useful to resolve a question. \n
-    Provide the binary score as a JSON with a single key 'score' and no preamble or explanation. <|eot_id|><|start_header_id|>assistant<|end_header_id|>""",
-    input_variables=["question", "document"],
-)
-
-retrieval_grader = retrieval_prompt | llm | JsonOutputParser()
+    Provide the binary score as a JSON with a single key 'score' and no preamble or explanation. <|eot_id|><|start_header_id|>assistant<|end_header_id|>"""
 
-decomposer_prompt = PromptTemplate(
-    template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+decomposer_template = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
     type : {type}
     when type == 1 then you will not decompose the question just return the same as one element in the list nothing else.
 ---------------------------------------------------------------------------------------------------------------------------
@@ -189,15 +352,22 @@ What is the capital of Japan?
 Your list should not contain empty strings or any notes.
 <|eot_id|><|start_header_id|>user<|end_header_id|>
 Question: {user_query} <|eot_id|><|start_header_id|>assistant<|end_header_id|>
-Decompositions:""",
-    input_variables=["user_query", "type"]
-)
+Decompositions:"""
 
-query_decompose = decomposer_prompt | llm | StrOutputParser()
+# Up to GRADER_CONCURRENCY grader calls per sub-question run concurrently; the process-wide
+# LLM throughput is bounded by clients.llm_limits. A web search decided during grading
+# starts as its own task so it overlaps the grader calls that are still in flight.
+GRADER_CONCURRENCY = int(os.getenv("GRADER_CONCURRENCY", "4"))
 
-from typing_extensions import TypedDict, List
-from IPython.display import Image, display
-from langgraph.graph import START, END, StateGraph
+# Retrieved chunks whose dense relevance score is decisive skip the grader (see grading.py).
+from grading import GraderThresholds, VerdictLog
+grader_thresholds = GraderThresholds.load()
+grader_log = VerdictLog(os.getenv("GRADER_LOG_PATH"))
+
+# Upper bound on sub-questions answered in parallel within one request.
+SUBQUESTION_CONCURRENCY = int(os.getenv("SUBQUESTION_CONCURRENCY", "4"))
+
+from typing_extensions import TypedDict, List, Any
 
 class GraphState(TypedDict):
     """
@@ -210,6 +380,7 @@ class GraphState(TypedDict):
         steps: List of steps taken in agent flow
         user_query: original user query, stored here for persistence during consolidation stage
         sub_answers: list of answers to decomposed questions
+        pending_search: web search task started by grade_documents, consumed by web_search
     """
     question: str
     generation: str
@@ -224,14 +395,16 @@ class GraphState(TypedDict):
     type: int
     latitude: float
     longitude: float
+    pending_search: Any
 
-def retrieve(state):
+@traced("node.retrieve")
+async def retrieve(state):
     """
     Retrieve documents
     This is the first Node invoked in the CRAG_graph
 
     # CRAG_graph is invoked in the CRAG_loop node:
-    #response = CRAG_graph.invoke({"question": q, "steps": steps})["generation"]
+    #response = (await get_CRAG_graph().ainvoke({"question": q, "steps": []}))["generation"]
     #we initialize the state with a sub-question and list of steps
 
     Args:
@@ -240,17 +413,25 @@ def retrieve(state):
     Returns:
         state (dict): New key added to state, documents, that contains retrieved documents
     """
-    print("---Retrieving Documents---", flush= True)
+    log_progress("---Retrieving Documents---", node="retrieve")
     question = state["question"]
     steps = state["steps"]
     steps.append("retrieve_documents")
-    documents = retriever.invoke(question)
+    documents = await get_retriever().ainvoke(question)
     return {"documents": documents, "question": question, "steps": steps}
 
-def grade_documents(state):
+async def grade_document(question, document, slots):
+    """"yes" or "no"; a malformed grader reply (missing or non-string score, not an object) counts as "no"."""
+    async with slots:
+        result = await get_chains().retrieval_grader.ainvoke({"question": question, "document": document.page_content})
+    return "yes" if isinstance(result, dict) and result.get("score") == "yes" else "no"
+
+@traced("node.grade_documents")
+async def grade_documents(state):
     """
     Determines whether the retrieved documents are relevant to the question. Store all relevant documents to the documents dictionary.
     However, if there is even one irrelevant document, then websearch will be invoked.
+    Documents whose retrieval score is decisive are accepted or rejected without an LLM call.
 
     Args:
         state (dict): The current graph state
@@ -258,20 +439,44 @@ def grade_documents(state):
     Returns:
         state (dict): Updates documents key with only filtered relevant documents
     """
-    print("---Grading Retrieved Documents---", flush= True)
+    log_progress("---Grading Retrieved Documents---", node="grade_documents")
     documents = state["documents"]
     question = state["question"]
     steps = state["steps"]
     steps.append("grade_document_retrieval")
-    relevant_docs = []
     search = "No"
-    for d in documents:
-        score = retrieval_grader.invoke({"question": question, "document": d.page_content})
-        if score["score"] == "yes":
-            relevant_docs.append(d)
-        else:
-            search = "Yes"
-    return {"documents": relevant_docs, "question": question, "search": search, "steps": steps}
+    pending_search = None
+    grader_slots = asyncio.Semaphore(GRADER_CONCURRENCY)
+
+    verdicts = [grader_thresholds.decide(d.metadata.get("relevance_score")) for d in documents]
+    if "no" in verdicts:
+        search = "Yes"
+        pending_search = asyncio.create_task(fetch_web_results(question))
+    tasks = {i: asyncio.create_task(grade_document(question, d, grader_slots)) for i, d in enumerate(documents) if verdicts[i] is None}
+    try:
+        for next_done in asyncio.as_completed(tasks.values()):
+            if await next_done != "yes" and pending_search is None:
+                # One "no" already decides the edge, so don't wait for the rest to start searching.
+                search = "Yes"
+                pending_search = asyncio.create_task(fetch_web_results(question))
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        if pending_search is not None:
+            # Nobody will consume it now. A search shared with other requests keeps running for them.
+            pending_search.cancel()
+        raise
+    for i, task in tasks.items():
+        verdicts[i] = task.result()
+    relevant_docs = [d for d, verdict in zip(documents, verdicts) if verdict == "yes"]
+    for i, verdict in enumerate(verdicts):
+        tracing.metrics.inc("rag_grader_verdicts_total", verdict=verdict, source="grader" if i in tasks else "score")
+    tracing.annotate(documents=len(documents), graded=len(tasks), grader_verdicts=",".join(verdicts))
+    await asyncio.to_thread(grader_log.write, [
+        {"question": question, "url": documents[i].metadata.get("url"), "score": documents[i].metadata.get("relevance_score"), "verdict": verdicts[i]}
+        for i in tasks
+    ])
+    return {"documents": relevant_docs, "question": question, "search": search, "steps": steps, "pending_search": pending_search}
 
 def decide_to_generate(state):
     """
@@ -293,32 +498,91 @@ def decide_to_generate(state):
     else:
         return "generate"
 
-def web_search(state):
-    print("---Searching the Web---", flush= True)
+async def fetch_web_results(question):
+    trusted_sites = ["ecoinvent.org", "openlca.org", "unep.org", "sciencebasedtargets.org", "climate-data.org", "ipcc.ch", "world.openfoodfacts.org"]
+    constrained_query = question + " " + " OR ".join([f"site:{site}" for site in trusted_sites])
+
+    async def search():
+        web_results = await asyncio.to_thread(get_web_cache().get, constrained_query)
+        record_cache_lookup("web", web_results is not None)
+        if web_results is None:
+            web_results = [{"content": d["content"], "url": d["url"]} for d in await get_web_search_tool().ainvoke({"query": constrained_query})]
+            await asyncio.to_thread(get_web_cache().set, constrained_query, web_results)
+        return web_results
+
+    # The shared search runs without any one request's deadline; each caller bounds its own wait.
+    web_results = await web_search_flight.do(constrained_query, search, timeout=request_time_left())
+
+    from langchain_core.documents import Document
+
+    return [
+        Document(page_content=d["content"], metadata={"url": d["url"]})
+        for d in web_results
+    ]
+
+async def write_back(question, web_results):
+    """Add new web results for `question` to the knowledge base, keeping graded-relevant ones only in "graded" mode."""
+    try:
+        knowledge_base = get_knowledge_base()
+        fresh = [d for d in web_results if knowledge_base.is_new(d)]
+        if fresh and KB_WRITEBACK == "graded":
+            slots = asyncio.Semaphore(GRADER_CONCURRENCY)
+            verdicts = await asyncio.gather(*(grade_document(question, d, slots) for d in fresh))
+            fresh = [d for d, verdict in zip(fresh, verdicts) if verdict == "yes"]
+        if fresh:
+            await asyncio.get_running_loop().run_in_executor(get_writeback_pool(), knowledge_base.add_documents, fresh)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+
+def submit_write_back(question, web_results):
+    """Start a write-back in the background, dropping it when KB_WRITEBACK_QUEUE are already in progress."""
+    if not writeback_slots.acquire(blocking=False):
+        tracing.metrics.inc("rag_writeback_total", result="dropped")
+        return
+    tracing.metrics.inc("rag_writeback_total", result="queued")
+    # Detached from the request: its deadline, trace and cancellation do not apply.
+    task = contextvars.Context().run(asyncio.create_task, write_back(question, web_results))
+    writeback_tasks.add(task)
+    task.add_done_callback(writeback_tasks.discard)
+    task.add_done_callback(lambda _: writeback_slots.release())
+
+async def drain_write_backs():
+    """Wait for the write-backs still in progress, e.g. before shutting down."""
+    if writeback_tasks:
+        await asyncio.gather(*writeback_tasks, return_exceptions=True)
+
+@traced("node.web_search")
+async def web_search(state):
+    log_progress("---Searching the Web---", node="web_search")
     documents = state.get("documents", [])
     question = state["question"]
     steps = state["steps"]
     steps.append("web_search")
 
-    trusted_sites = ["ecoinvent.org", "openlca.org", "unep.org", "sciencebasedtargets.org", "climate-data.org", "ipcc.ch", "world.openfoodfacts.org"]
-    constrained_query = question + " " + " OR ".join([f"site:{site}" for site in trusted_sites])
+    pending_search = state.get("pending_search")
+    if pending_search is not None:
+        web_results = await pending_search
+    else:
+        web_results = await fetch_web_results(question)
 
-    web_results = web_search_tool.invoke({"query": constrained_query})
+    if KB_WRITEBACK != "off":
+        submit_write_back(question, list(web_results))
 
-    documents.extend(
-        [
-            Document(page_content=d["content"], metadata={"url": d["url"]})
-            for d in web_results
-        ]
-    )
+    documents.extend(web_results)
     return {
         "documents": documents,
         "question": question,
-        "steps": steps
+        "steps": steps,
+        "pending_search": None
     }
 
 
-def generate(state):
+# Prompts get deduplicated, token-budgeted context instead of Python reprs (see context_packing.py).
+from context_packing import pack_documents, pack_answers
+
+@traced("node.generate")
+async def generate(state):
     """
     Generate answer with location context
 
@@ -328,7 +592,7 @@ def generate(state):
     Returns:
         state (dict): New key added to state, generation, that contains LLM generation
     """
-    print("---Generating Response---", flush = True)
+    log_progress("---Generating Response---", node="generate")
     documents = state["documents"]
     question = state["question"]
     steps = state["steps"]
@@ -337,8 +601,8 @@ def generate(state):
     steps.append("generating sub-answer")
     query_type = state.get("type", 2)
     
-    generation = rag_chain.invoke({
-        "documents": documents, 
+    generation = await get_chains().rag_chain.ainvoke({
+        "documents": pack_documents(documents),
         "question": question,
         "latitude": latitude,
         "longitude": longitude
@@ -351,22 +615,22 @@ def generate(state):
         "steps": steps
     }
 
-CRAG = StateGraph(GraphState)
-
-CRAG = StateGraph(GraphState)
-CRAG.add_node("retrieve", retrieve)
-CRAG.add_node("grade_documents", grade_documents)
-CRAG.add_node("generate", generate)
-CRAG.add_node("web_search", web_search)
-CRAG.set_entry_point("retrieve")
-CRAG.add_edge("retrieve", "grade_documents")
-CRAG.add_conditional_edges("grade_documents", decide_to_generate, {"search": "web_search", "generate": "generate"})
-CRAG.add_edge("web_search", "generate")
-CRAG.add_edge("generate", END)
-CRAG_graph = CRAG.compile()
-
-json_structure_prompt = PromptTemplate(
-    template="""
+@lazy
+def get_CRAG_graph():
+    from langgraph.graph import END, StateGraph
+    CRAG = StateGraph(GraphState)
+    CRAG.add_node("retrieve", retrieve)
+    CRAG.add_node("grade_documents", grade_documents)
+    CRAG.add_node("generate", generate)
+    CRAG.add_node("web_search", web_search)
+    CRAG.set_entry_point("retrieve")
+    CRAG.add_edge("retrieve", "grade_documents")
+    CRAG.add_conditional_edges("grade_documents", decide_to_generate, {"search": "web_search", "generate": "generate"})
+    CRAG.add_edge("web_search", "generate")
+    CRAG.add_edge("generate", END)
+    return CRAG.compile()
+
+json_structure_template = """
 <|begin_of_text|><|start_header_id|>system<|end_header_id|>
 You are an assistant formatting environmental impact assessments.
 Given the following unstructured answer, return a JSON object with the following fields:
@@ -392,20 +656,141 @@ Unstructured Answer:
 {text}
 IMPORTANT :: DO NOT GIVE ANY OUTPUT OTHER THAN JSON OBJECT. NOT EVEN A NOTE NO-THING. 
 <|eot_id|><|start_header_id|>assistant<|end_header_id|>
-""",
-    input_variables=["text"],
-)
+"""
+
+# Type 1 answers are generated directly in the answer card schema in one pass. The
+# json_consolidator reformatting call above is only used as a fallback when the output
+# still fails validation after local repair.
+structured_final_template = """
+<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+You are an assistant for environmental product questions, providing comprehensive answers about the environmental impacts of products, including their carbon footprint, water usage, waste generation, and other relevant factors. You should also suggest actionable steps to reduce environmental impact and provide citations for your information.
+Given the following context and user question, return a JSON object with exactly these fields:
+
+{{
+  "rating": Number (0-100, representing your rating as an environmental expert, of the impacts of using that product),
+  "text": String (comprehensive answer addressing environmental impacts including carbon footprint, water usage, waste generation, etc.),
+  "citations": [ {{"label": String, "url": String}} ] (list of source URLs that support your answer, minimum 1 source),
+  "recommendations": [ {{"text": String}} ] (2-3 actionable suggestions for reducing environmental impact),
+  "suggestedQuestions": [ String ] (3-4 related follow-up questions users might want to ask)
+}}
+
+Tips for each field:
+- rating: Consider data quality, source reliability, and how complete the information is
+- text: Markdown. Structure the answer logically, use specific numbers/metrics when available (DO NOT answer in more than 4-5 points for this part cover everything important such as:
+   1.The way the user could use it in a better way and how to use it mindfully.
+   2.What are the ways it affects the environment.
+   3.How can it be harmful for different people and how it affects the health.
+   4.try to make them a bit aware of the long term damage the product causes.
+   5.How can they try their best to use the harmful wastes produced from the product into something good or how can they minimise it if not make it useful.
+   )
+- citations: Always link to authoritative sources like environmental databases or research papers, use links instead of texts
+- recommendations: Focus on practical, achievable actions for consumers
+- suggestedQuestions: Questions should explore related environmental aspects not covered in main answer
+
+CONSIDER THE USER'S LOCATION, GIVEN BY LATITUDE AND LONGITUDE, WHILE ANSWERING.
+Context: {documents}
+Question: {question}
+Latitude: {latitude}
+Longitude: {longitude}
+IMPORTANT :: DO NOT GIVE ANY OUTPUT OTHER THAN THE JSON OBJECT. NOT EVEN A NOTE NO-THING.
+<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+"""
+
+@lazy
+def get_chains():
+    from types import SimpleNamespace
+    from langchain_core.prompts import PromptTemplate
+    from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
+    llm = get_llm()
+    prompt = PromptTemplate(template=rag_template, input_variables=["question", "documents"])
+    final_prompt = PromptTemplate(template=final_template, input_variables=["question", "documents", "type", "latitude", "longitude"])
+    retrieval_prompt = PromptTemplate(template=retrieval_template, input_variables=["question", "document"])
+    decomposer_prompt = PromptTemplate(template=decomposer_template, input_variables=["user_query", "type"])
+    json_structure_prompt = PromptTemplate(template=json_structure_template, input_variables=["text"])
+    structured_final_prompt = PromptTemplate(template=structured_final_template, input_variables=["question", "documents", "latitude", "longitude"])
+    return SimpleNamespace(
+        rag_chain=prompt | llm | StrOutputParser(),
+        final_rag_chain=final_prompt | llm,
+        retrieval_grader=retrieval_prompt | llm | JsonOutputParser(),
+        query_decompose=decomposer_prompt | llm | StrOutputParser(),
+        json_consolidator=json_structure_prompt | llm | StrOutputParser(),
+        structured_rag_chain=structured_final_prompt | llm | StrOutputParser(),
+    )
 
-json_consolidator = json_structure_prompt | llm | StrOutputParser()
+@lazy
+def get_structured_stats():
+    from structured_output import StructuredOutputStats
+    return StructuredOutputStats()
+
+async def build_answer_card(raw_response, steps):
+    """
+    Validate the single-pass type 1 output, falling back to one json_consolidator retry.
 
-def transform_query(state: dict) -> dict:
+    Returns:
+        dict or None: the validated answer card, None if the retry also failed
+    """
+    from structured_output import parse_assessment
+    structured_stats = get_structured_stats()
+    try:
+        card = parse_assessment(raw_response)
+        structured_stats.record("single_pass")
+        return card
+    except ValueError:
+        pass
+    log_progress("---Reformatting Structured Response---", node="consolidate")
+    steps.append("structured output retry")
+    try:
+        card = parse_assessment(await get_chains().json_consolidator.ainvoke({"text": raw_response}))
+        structured_stats.record("retried")
+        return card
+    except ValueError:
+        structured_stats.record("failed")
+        return None
+
+# Type 1 questions name a single product and the decomposer is told to return them
+# unchanged, so they skip the decomposition call. Type 2 questions skip it too when
+# they look single-aspect: short, one question, no comparison or conjunction.
+# ROUTER_MODE=off sends every type 2 question through transform_query.
+ROUTER_MODE = os.getenv("ROUTER_MODE", "heuristic")
+ROUTER_MAX_WORDS = int(os.getenv("ROUTER_MAX_WORDS", "14"))
+MULTI_ASPECT_PATTERN = re.compile(r"\b(and|or|vs|versus|compared?|comparison|between|than|as well as|also)\b|[,;]|\?.*\?", re.IGNORECASE)
+
+def route_query(user_query, query_type):
+    """Return ("direct" | "decompose", reason)."""
+    if query_type == 1:
+        return "direct", "type 1"
+    if ROUTER_MODE == "off":
+        return "decompose", "router off"
+    if len(user_query.split()) > ROUTER_MAX_WORDS:
+        return "decompose", "long query"
+    if MULTI_ASPECT_PATTERN.search(user_query):
+        return "decompose", "multi-aspect"
+    return "direct", "single-aspect"
+
+@traced("node.route")
+async def route(state: dict) -> dict:
+    user_query = state["user_query"]
+    steps = state["steps"]
+    decision, reason = route_query(user_query, state.get("type", 2))
+    tracing.annotate(route=decision, reason=reason)
+    tracing.metrics.inc("rag_route_total", route=decision, reason=reason)
+    steps.append(f"route: {decision} ({reason})")
+    if decision == "direct":
+        return {**state, "sub_questions": [user_query], "steps": steps}
+    return {**state, "sub_questions": [], "steps": steps}
+
+def decide_to_decompose(state):
+    return "decompose" if not state["sub_questions"] else "direct"
+
+@traced("node.transform_query")
+async def transform_query(state: dict) -> dict:
     user_query = state["user_query"]
     steps = state["steps"]
     query_type = state.get("type", 2)
-    print("---Decomposing the QUERY---", flush=True)
+    log_progress("---Decomposing the QUERY---", node="transform_query")
     steps.append("transform_query")
     type = state["type"]
-    sub_questions = query_decompose.invoke({"user_query": user_query, "type" : type})
+    sub_questions = await get_chains().query_decompose.ainvoke({"user_query": user_query, "type" : type})
     list_of_questions = [q.strip() for q in sub_questions.strip().split('\n')]
 
     if list_of_questions[0] == 'The question needs no decomposition':
@@ -422,18 +807,49 @@ def transform_query(state: dict) -> dict:
         }
 
 
-def CRAG_loop(state: dict) -> dict:
+async def gather_or_cancel(*aws):
+    """asyncio.gather that cancels the remaining awaitables on the first failure (TaskGroup-style, Python 3.10)."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+@traced("node.CRAG_loop")
+async def CRAG_loop(state: dict) -> dict:
     questions = state["sub_questions"]
     steps = state["steps"]
     user_query = state["user_query"]
     query_type = state.get("type", 2)
-    sub_answers = []
 
     steps.append("entering iterative CRAG for sub questions")
 
-    for q in questions:
-        response = CRAG_graph.invoke({"question": q, "steps": steps, "type": query_type})["generation"]
-        sub_answers.append(response)
+    branch_slots = asyncio.Semaphore(SUBQUESTION_CONCURRENCY)
+
+    async def answer(index, q):
+        # Each branch gets its own steps list; they are merged back in question order below.
+        async with branch_slots:
+            with tracing.span("crag.subquestion", index=index, question=q):
+                if "sub" not in ANSWER_CACHE_MODES:
+                    return await get_CRAG_graph().ainvoke({"question": q, "steps": [], "type": query_type})
+                key = f"sub|{query_type}|{normalize_query(q)}"
+                scope = f"sub|{query_type}"
+                cached, vector = await get_answer_cache().alookup(key, scope, q)
+                record_cache_lookup("sub_answer", cached is not None)
+                if cached is not None:
+                    return {"generation": cached, "steps": ["sub-answer served from cache"]}
+                result = await get_CRAG_graph().ainvoke({"question": q, "steps": [], "type": query_type})
+                await get_answer_cache().asave(key, scope, q, result["generation"], vector)
+                return result
+
+    tracing.annotate(sub_questions=len(questions))
+    # One failed branch fails the request; don't keep spending LLM calls on the others.
+    results = await gather_or_cancel(*(answer(i, q) for i, q in enumerate(questions)))
+
+    sub_answers = [result["generation"] for result in results]
+    for result in results:
+        steps.extend(result["steps"])
 
     return {
         **state,
@@ -442,8 +858,9 @@ def CRAG_loop(state: dict) -> dict:
     }
 
 
-def consolidate(state: dict) -> dict:
-    print("---Consolidating Response---", flush= True)
+@traced("node.consolidate")
+async def consolidate(state: dict) -> dict:
+    log_progress("---Consolidating Response---", node="consolidate")
     answers = state['sub_answers']
     questions = state['sub_questions']
     user_query = state['user_query']
@@ -455,17 +872,20 @@ def consolidate(state: dict) -> dict:
     steps.append("generating final answer")
     if query_type == 1:
         qa_pairs = [{questions[i]: answers[i].strip()} for i in range(min(len(questions), len(answers)))]
-        raw_response = final_rag_chain.invoke({"documents": qa_pairs, "question": user_query, "type" : 1, "latitude": latitude, "longitude": longitude})
-        structured_response = json_consolidator.invoke({"text": raw_response})
+        raw_response = await stream_tokens(get_chains().structured_rag_chain.astream({"documents": pack_answers(questions, answers), "question": user_query, "latitude": latitude, "longitude": longitude}))
+        card = await build_answer_card(raw_response, steps)
+        # The frontend parses final_response as a fenced JSON block.
+        structured_response = "```json\n" + json.dumps(card, indent=2) + "\n```" if card else raw_response
         return {
             **state,
             "final_response": structured_response,
+            "structured_output": card,
             "steps": steps,
             "intermediate_qa": qa_pairs,
         }
     else:
         qa_pairs = [{questions[i]: answers[i].strip()} for i in range(min(len(questions), len(answers)))]
-        raw_response = final_rag_chain.invoke({"documents": qa_pairs, "question": user_query, "type" : 2, "latitude": latitude, "longitude": longitude})
+        raw_response = await stream_tokens(get_chains().final_rag_chain.astream({"documents": pack_answers(questions, answers), "question": user_query, "type" : 2, "latitude": latitude, "longitude": longitude}))
         return {
             **state,
             "final_response": raw_response,
@@ -474,33 +894,123 @@ def consolidate(state: dict) -> dict:
         }
 
 
-nested_CRAG = StateGraph(GraphState)
-nested_CRAG.add_node("transform_query", transform_query)
-nested_CRAG.add_node("CRAG_loop", CRAG_loop)
-nested_CRAG.add_node("consolidate", consolidate)
-nested_CRAG.set_entry_point("transform_query")
-nested_CRAG.add_edge("transform_query", "CRAG_loop")
-nested_CRAG.add_edge("CRAG_loop", "consolidate")
-nested_CRAG.add_edge("consolidate", END)
-
-agentic_rag = nested_CRAG.compile()
-
-if len(sys.argv) >= 5:
-    user_query = sys.argv[1]
+@lazy
+def get_agentic_rag():
+    from langgraph.graph import END, StateGraph
+    nested_CRAG = StateGraph(GraphState)
+    nested_CRAG.add_node("route", route)
+    nested_CRAG.add_node("transform_query", transform_query)
+    nested_CRAG.add_node("CRAG_loop", CRAG_loop)
+    nested_CRAG.add_node("consolidate", consolidate)
+    nested_CRAG.set_entry_point("route")
+    nested_CRAG.add_conditional_edges("route", decide_to_decompose, {"decompose": "transform_query", "direct": "CRAG_loop"})
+    nested_CRAG.add_edge("transform_query", "CRAG_loop")
+    nested_CRAG.add_edge("CRAG_loop", "consolidate")
+    nested_CRAG.add_edge("consolidate", END)
+    return nested_CRAG.compile()
+
+# Old module attribute names, resolved lazily (PEP 562) for the API, ingest.py and bench.py.
+LAZY_ATTRIBUTES = {
+    "clients": get_clients,
+    "watsonx": get_watsonx,
+    "embeddings": get_embeddings,
+    "vectorstore": get_vectorstore,
+    "knowledge_base": get_knowledge_base,
+    "writeback_pool": get_writeback_pool,
+    "retriever": get_retriever,
+    "answer_cache": get_answer_cache,
+    "web_cache": get_web_cache,
+    "web_search_tool": get_web_search_tool,
+    "llm": get_llm,
+    "structured_stats": get_structured_stats,
+    "CRAG_graph": get_CRAG_graph,
+    "agentic_rag": get_agentic_rag,
+}
+
+def __getattr__(name):
+    if name in LAZY_ATTRIBUTES:
+        return LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def build():
+    """Construct every client, index, chain and graph now instead of on the first request."""
+    for get in (get_clients, get_retriever, get_writeback_pool, get_answer_cache, get_web_cache,
+                get_web_search_tool, get_chains, get_structured_stats, get_CRAG_graph, get_agentic_rag):
+        get()
+
+def coerce_inputs(type, latitude, longitude):
+    """Parse the loosely-typed CLI/HTTP inputs the same way for every serving mode."""
     try:
-        type = int(sys.argv[2])
-    except (ValueError, IndexError):
+        type = int(type)
+    except (TypeError, ValueError):
         type = 2
     try:
-        latitude = float(sys.argv[3])
-    except (ValueError, IndexError):
+        latitude = float(latitude)
+    except (TypeError, ValueError):
         latitude = None
     try:
-        longitude = float(sys.argv[4])
-    except (ValueError, IndexError):
+        longitude = float(longitude)
+    except (TypeError, ValueError):
         longitude = None
-    response = agentic_rag.invoke({"user_query": user_query, "steps": [], "type" : type, "latitude": latitude, "longitude": longitude})
-    print("===RESULT===")
-    print(json.dumps({"result": response}), flush=True)
-else:
-    print("Not enough arguments received.")
\ No newline at end of file
+    return type, latitude, longitude
+
+
+async def arun_query(user_query, type, latitude, longitude, sink=None):
+    """
+    Run the nested CRAG pipeline once on the already compiled agentic_rag graph.
+
+    Args:
+        sink: optional callable receiving progress/token event dicts instead of stdout
+
+    Returns:
+        dict: final graph state, as printed after ===RESULT=== by the CLI
+    """
+    type, latitude, longitude = coerce_inputs(type, latitude, longitude)
+    token = _progress_sink.set(sink)
+    try:
+        with tracing.span("agentic_rag", type=type):
+            if "final" not in ANSWER_CACHE_MODES:
+                return await get_agentic_rag().ainvoke({"user_query": user_query, "steps": [], "type" : type, "latitude": latitude, "longitude": longitude})
+            bucket = location_bucket(latitude, longitude, LOCATION_BUCKET_DEGREES)
+            key = f"final|{type}|{bucket}|{normalize_query(user_query)}"
+            scope = f"final|{type}|{bucket}"
+            cached, vector = await get_answer_cache().alookup(key, scope, user_query)
+            record_cache_lookup("answer", cached is not None)
+            if cached is not None:
+                log_progress("---Serving Cached Response---", node="answer_cache")
+                return {**cached, "user_query": user_query, "steps": ["served from answer cache"]}
+            response = await get_agentic_rag().ainvoke({"user_query": user_query, "steps": [], "type" : type, "latitude": latitude, "longitude": longitude})
+            if type == 1 and response.get("structured_output") is None:
+                # The answer card failed to parse; caching it would serve the failure until it expires.
+                return response
+            await get_answer_cache().asave(key, scope, user_query, response, vector)
+            return response
+    finally:
+        _progress_sink.reset(token)
+
+
+def run_query(user_query, type, latitude, longitude, sink=None):
+    """Blocking wrapper around arun_query for the CLI; also waits for the query's write-backs."""
+    async def run():
+        try:
+            return await arun_query(user_query, type, latitude, longitude, sink=sink)
+        finally:
+            await drain_write_backs()
+    return asyncio.run(run())
+
+
+def main(argv):
+    if len(argv) >= 5:
+        response = run_query(argv[1], argv[2], argv[3], argv[4])
+        if get_writeback_pool.built():
+            # A one-shot process never reaches KB_SAVE_INTERVAL: persist its write-backs now.
+            get_writeback_pool().shutdown(wait=True)
+            get_knowledge_base().save()
+        print("===RESULT===")
+        print(json.dumps({"result": response}), flush=True)
+    else:
+        print("Not enough arguments received.")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,14 +1,45 @@
 import os
+import json
+import asyncio
 import subprocess
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from starlette.concurrency import iterate_in_threadpool
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
+from admission import AdmissionController, AdmissionRejected
+from cache import normalize_query, location_bucket
+from coalescing import RequestCoalescer
+import tracing
 
 load_dotenv()
 app = FastAPI()
 API_KEY = os.getenv("API_KEY")
 
+# "inprocess" runs the async pipeline of one imported base_rag module directly on the
+# event loop; "subprocess" keeps the old behaviour of spawning base_rag.py per request.
+RAG_WORKER_MODE = os.getenv("RAG_WORKER_MODE", "inprocess")
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+worker_path = os.path.join(script_dir, 'base_rag.py')
+
+rag = None
+
+# Bounds how many pipelines run at once (each holds LLM calls against the shared watsonx
+# quota); excess requests wait in a per-client fair queue or get a fast 429.
+admission = AdmissionController(
+    max_concurrency=int(os.getenv("ASK_MAX_CONCURRENCY", "8")),
+    max_queue=int(os.getenv("ASK_MAX_QUEUE", "32")),
+    max_wait=float(os.getenv("ASK_QUEUE_TIMEOUT", "30")),
+)
+# Default end-to-end budget of one /ask request; clients may lower it with x-request-timeout.
+ASK_REQUEST_TIMEOUT = float(os.getenv("ASK_REQUEST_TIMEOUT", "180"))
+
+# Identical questions (same normalized query, type and location bucket) that arrive while
+# one is already running attach to that run instead of starting their own pipeline.
+ASK_COALESCE = os.getenv("ASK_COALESCE", "1") == "1"
+coalescer = RequestCoalescer()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "https://climate-change-silk.vercel.app"],
@@ -17,6 +48,150 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def load_rag():
+    # Pay for the heavy imports, client construction, FAISS load and graph compilation
+    # once per process instead of once per request.
+    global rag
+    if RAG_WORKER_MODE == "inprocess":
+        import base_rag
+        base_rag.build()
+        rag = base_rag
+
+@app.on_event("shutdown")
+async def stop_workers():
+    if rag is not None:
+        await rag.drain_write_backs()
+        rag.writeback_pool.shutdown(wait=True)
+        rag.knowledge_base.save()
+
+
+def stream_subprocess(user_query, type_, latitude, longitude):
+    process = subprocess.Popen(
+        ['python', '-u', worker_path, str(user_query), str(type_), str(latitude), str(longitude)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1
+    )
+    for line in iter(process.stdout.readline, ''):
+        yield line
+    process.stdout.close()
+    process.wait()
+
+
+async def run_inprocess(user_query, type_, latitude, longitude, timeout):
+    """Run one query on the event loop, yielding its progress/token events and a final result event."""
+    events = asyncio.Queue()
+
+    async def work():
+        # Every watsonx/Tavily call made for this request inherits its deadline.
+        deadline = rag.clients.set_deadline(timeout)
+        try:
+            response = await rag.arun_query(user_query, type_, latitude, longitude, sink=events.put_nowait)
+            events.put_nowait({"event": "result", "result": response})
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            events.put_nowait({"event": "error", "error": str(e)})
+        finally:
+            rag.clients.reset_deadline(deadline)
+            events.put_nowait(None)
+
+    task = asyncio.create_task(work())
+    try:
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            yield event
+    finally:
+        # Nobody is listening any more: stop spending LLM calls on it.
+        if not task.done():
+            task.cancel()
+
+
+def format_event(event, stream_format):
+    """
+    Render one pipeline event for the response body.
+
+    "text" reproduces the CLI output (progress lines, then ===RESULT=== and the JSON
+    result) and drops token events; "ndjson" and "sse" carry every event.
+    """
+    if stream_format == "ndjson":
+        return json.dumps(event) + "\n"
+    if stream_format == "sse":
+        payload = {k: v for k, v in event.items() if k != "event"}
+        return f"event: {event['event']}\ndata: {json.dumps(payload)}\n\n"
+    if event["event"] == "progress":
+        return event["message"] + "\n"
+    if event["event"] == "result":
+        return "===RESULT===\n" + json.dumps({"result": event["result"]}) + "\n"
+    if event["event"] == "error":
+        return f"Error: {event['error']}\n"
+    return ""
+
+
+STREAM_MEDIA_TYPES = {"text": "text/plain", "ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+
+def pick_stream_format(request, body):
+    requested = body.get("stream")
+    if requested in STREAM_MEDIA_TYPES:
+        return requested
+    accept = request.headers.get("accept", "")
+    if "text/event-stream" in accept:
+        return "sse"
+    if "application/x-ndjson" in accept:
+        return "ndjson"
+    return "text"
+
+
+async def stream_events(events, stream_format):
+    async for event in events:
+        chunk = format_event(event, stream_format)
+        if chunk:
+            yield chunk
+
+
+def coalesce_key(user_query, type_, latitude, longitude):
+    type_, latitude, longitude = rag.coerce_inputs(type_, latitude, longitude)
+    return f"{type_}|{location_bucket(latitude, longitude, rag.LOCATION_BUCKET_DEGREES)}|{normalize_query(user_query)}"
+
+
+def client_key(request):
+    """
+    Fair-queueing key of the end client: an explicit x-client-id, else the first
+    x-forwarded-for hop (set by the Next.js proxy), else the peer address. Only requests
+    carrying the API key get this far, so the forwarded headers come from our proxy.
+    """
+    client_id = request.headers.get("x-client-id")
+    if client_id:
+        return client_id
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded:
+        return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def request_timeout(request):
+    try:
+        return min(ASK_REQUEST_TIMEOUT, float(request.headers["x-request-timeout"]))
+    except (KeyError, ValueError):
+        return ASK_REQUEST_TIMEOUT
+
+
+async def release_when_done(chunks, slot):
+    """Stream `chunks` (sync or async) and give the admission slot back when the response ends."""
+    try:
+        if not hasattr(chunks, "__aiter__"):
+            chunks = iterate_in_threadpool(chunks)
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        admission.release(slot)
+
+
 @app.post("/ask")
 async def ask_rag(request: Request):
     api_key = request.headers.get("x-api-key")
@@ -30,24 +205,72 @@ async def ask_rag(request: Request):
         type_ = body.get("type")
         latitude = body.get("latitude")
         longitude = body.get("longitude")
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        worker_path = os.path.join(script_dir, 'base_rag.py')
-
-        def generate():
-            process = subprocess.Popen(
-                ['python', '-u', worker_path, str(user_query), str(type_), str(latitude), str(longitude)],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1
-            )
-            for line in iter(process.stdout.readline, ''):
-                yield line
-            process.stdout.close()
-            process.wait()
+
+        key = coalesce_key(user_query, type_, latitude, longitude) if rag is not None and ASK_COALESCE else None
+        stream_format = pick_stream_format(request, body) if rag is not None else "text"
         print(user_query)
-        return StreamingResponse(generate(), media_type="text/plain")
+        if key is not None and coalescer.running(key):
+            # Joining a run costs no pipeline work, so it does not take an admission slot.
+            return StreamingResponse(stream_events(coalescer.join(key, None), stream_format), media_type=STREAM_MEDIA_TYPES[stream_format])
+        try:
+            slot = await admission.acquire(client_key(request))
+        except AdmissionRejected as e:
+            return JSONResponse(
+                {"error": f"Server busy: {e.reason}"},
+                status_code=429,
+                headers={"Retry-After": str(e.retry_after)},
+            )
+        if rag is None:
+            generate = release_when_done(stream_subprocess(user_query, type_, latitude, longitude), slot)
+        elif key is None:
+            generate = stream_events(release_when_done(run_inprocess(user_query, type_, latitude, longitude, request_timeout(request)), slot), stream_format)
+        else:
+            if coalescer.running(key):
+                # An identical request started while this one was queued.
+                admission.release(slot)
+            # The slot is held by the run itself, not by whichever request started it.
+            timeout = request_timeout(request)
+            events = coalescer.join(key, lambda: release_when_done(run_inprocess(user_query, type_, latitude, longitude, timeout), slot))
+            generate = stream_events(events, stream_format)
+        return StreamingResponse(generate, media_type=STREAM_MEDIA_TYPES[stream_format])
     except Exception as e:
         import traceback
         traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Internal error: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Internal error: {str(e)}")
+
+
+
+@app.get("/stats")
+async def stats(request: Request):
+    if request.headers.get("x-api-key") != API_KEY:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    result = {"admission": admission.stats(), "coalescing": coalescer.stats()}
+    if rag is not None:
+        result["answer_cache"] = rag.answer_cache.stats()
+        result["web_cache"] = rag.web_cache.stats()
+        result["structured_output"] = rag.structured_stats.snapshot()
+        result["embeddings"] = rag.embeddings.stats()
+    return result
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus exposition of pipeline span timings, token/cache/grader counters and queue gauges."""
+    admission_stats = admission.stats()
+    buckets = admission_stats.pop("wait_seconds_buckets")
+    body = tracing.metrics.render() + tracing.render_gauges("rag_admission", admission_stats)
+    body += tracing.render_gauges("rag_coalescing", coalescer.stats())
+    body += "# TYPE rag_admission_wait_seconds histogram\n"
+    cumulative = 0
+    for bound, count in buckets.items():
+        cumulative += count
+        body += f'rag_admission_wait_seconds_bucket{{le="{bound}"}} {cumulative}\n'
+    body += f'rag_admission_wait_seconds_bucket{{le="+Inf"}} {admission.wait_count}\n'
+    body += f"rag_admission_wait_seconds_sum {admission.wait_sum}\n"
+    body += f"rag_admission_wait_seconds_count {admission.wait_count}\n"
+    if rag is not None:
+        body += tracing.render_gauges("rag_answer_cache", rag.answer_cache.stats())
+        body += tracing.render_gauges("rag_web_cache", rag.web_cache.stats())
+        body += tracing.render_gauges("rag_structured_output", rag.structured_stats.snapshot())
+        body += tracing.render_gauges("rag_embeddings", rag.embeddings.stats())
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
@@ -0,0 +1,121 @@
+import asyncio
+import contextvars
+import threading
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+from cache import normalize_query
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that coalesces concurrent query embeddings into batched requests.
+
+    `aembed_query` callers on the event loop are collected for up to `max_delay` seconds
+    or `max_batch` texts, embedded with one `aembed_documents` call and handed their own
+    vector back. Query vectors are kept in an LRU keyed by the normalized text, so repeat
+    queries skip the remote call entirely. Document embedding is already batched by its
+    callers and passes straight through.
+
+    A batch runs in a fresh context, not in that of whichever caller filled it or armed
+    the timer, so one request's deadline and trace never apply to the others. Each caller
+    waits for its own vector for at most `timeout()` seconds (None: no limit).
+    """
+
+    def __init__(self, inner, max_batch=32, max_delay=0.005, cache_size=10000, timeout=None):
+        self.inner = inner
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._pending = []  # (normalized key, text, future)
+        self._timer = None
+        self._in_flight = set()  # strong references to running batch tasks
+        self.batches = 0
+        self.batched_queries = 0
+        self.cache_hits = 0
+
+    def _cached(self, key):
+        with self._cache_lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+            return vector
+
+    def _remember(self, key, vector):
+        with self._cache_lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def embed_documents(self, texts):
+        return self.inner.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        return await self.inner.aembed_documents(texts)
+
+    def embed_query(self, text):
+        key = normalize_query(text)
+        vector = self._cached(key)
+        if vector is None:
+            vector = self.inner.embed_query(text)
+            self._remember(key, vector)
+        return vector
+
+    async def aembed_query(self, text):
+        key = normalize_query(text)
+        vector = self._cached(key)
+        if vector is not None:
+            return vector
+        timeout = self.timeout() if self.timeout else None
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((key, text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._flush_now)
+        return await asyncio.wait_for(future, timeout)
+
+    def _flush_now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            # A task copies the current context; create it inside an empty one.
+            task = contextvars.Context().run(asyncio.get_running_loop().create_task, self._embed_batch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _embed_batch(self, batch):
+        # One text per normalized key; the first caller's spelling is the one embedded.
+        texts = {}
+        for key, text, _ in batch:
+            texts.setdefault(key, text)
+        self.batches += 1
+        self.batched_queries += len(batch)
+        try:
+            vectors = dict(zip(texts, await self.inner.aembed_documents(list(texts.values()))))
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, vector in vectors.items():
+            self._remember(key, vector)
+        for key, _, future in batch:
+            if not future.done():
+                future.set_result(vectors[key])
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "batched_queries": self.batched_queries,
+            "cache_hits": self.cache_hits,
+            "cached_vectors": len(self._cache),
+        }
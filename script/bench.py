@@ -0,0 +1,337 @@
+"""
+Latency and throughput benchmark for agentic_rag on the fake backends (see fakes.py).
+
+    python bench.py run --target graph --concurrency 1,4,16 --requests 48 --output bench.json
+    python bench.py run --type 1 --concurrency 1,8 --requests 16
+    python bench.py run --target api --concurrency 1,8,32 --output bench-api.json
+    python bench.py compare old.json new.json
+    python bench.py imports --budget-ms 300
+
+The graph target calls arun_query directly on one event loop; the api target starts
+uvicorn on base_rag_api (or uses --url) and streams /ask as NDJSON. Each concurrency
+level reports p50/p95/p99 latency, time to first byte (first event of any kind),
+time to first answer token, requests/sec and peak RSS of the process serving the
+pipeline. The index, caches and sqlite files live in a fresh temporary directory, and
+answer/web caching is off unless --cache is given, so runs are comparable across commits.
+`run` exits non-zero when any request failed, so it doubles as a smoke test of both
+query types (the default corpus mixes type 1 and type 2).
+
+`imports` checks that `import base_rag` stays cheap: it runs `python -X importtime`, fails
+when the import takes longer than the budget or pulls in one of the heavy packages that
+base_rag only loads on first use, and lists the slowest modules. tests/test_import_time.py
+runs the same checks under pytest.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+QUERIES_PATH = os.path.join(SCRIPT_DIR, "bench_queries.json")
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def peak_rss_mb(pid=None):
+    """High-water RSS of `pid` (from /proc), or of this process."""
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def prepare_environment(workdir, cache, index_size):
+    """Point the pipeline at fake backends and a seeded index in `workdir`; must run before importing base_rag."""
+    index_path = os.path.join(workdir, "faiss_index")
+    os.environ.update({
+        "RAG_BACKEND": "fake",
+        "FAISS_INDEX_PATH": index_path,
+        "ANSWER_CACHE_PATH": os.path.join(workdir, "rag_cache.sqlite"),
+        "WEB_CACHE_PATH": os.path.join(workdir, "rag_cache.sqlite"),
+        "KB_WRITEBACK": os.getenv("KB_WRITEBACK", "off"),
+    })
+    if not cache:
+        os.environ["ANSWER_CACHE_MODES"] = ""
+        os.environ["WEB_CACHE_TTL"] = "0"
+    if not os.path.exists(index_path):
+        from langchain_community.vectorstores import FAISS
+        import fakes
+        FAISS.from_texts(fakes.corpus(index_size), fakes.FakeEmbeddings(latency=0, per_text=0)).save_local(index_path)
+
+
+def summarize(concurrency, samples, errors, elapsed, rss):
+    latencies = [s["latency"] for s in samples]
+    ttfb = [s["ttfb"] for s in samples if s["ttfb"] is not None]
+    ttft = [s["ttft"] for s in samples if s["ttft"] is not None]
+    row = {"concurrency": concurrency, "requests": len(samples) + errors, "errors": errors}
+    for name, values in (("latency", latencies), ("ttfb", ttfb), ("ttft", ttft)):
+        for q in (50, 95, 99):
+            row[f"{name}_p{q}"] = percentile(values, q)
+    row["rps"] = len(samples) / elapsed if elapsed else 0.0
+    row["elapsed"] = elapsed
+    row["peak_rss_mb"] = rss
+    return row
+
+
+async def drive(call, queries, concurrency, total):
+    """Run `total` requests from `queries` round robin with `concurrency` workers."""
+    samples, errors = [], 0
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index, errors
+        while next_index < total:
+            query = queries[next_index % len(queries)]
+            next_index += 1
+            try:
+                samples.append(await call(query))
+            except Exception as e:
+                errors += 1
+                print(f"request failed: {e!r}", file=sys.stderr)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples, errors, time.perf_counter() - started
+
+
+async def graph_call(rag, query):
+    started = time.perf_counter()
+    marks = {"ttfb": None, "ttft": None}
+
+    def sink(event):
+        now = time.perf_counter() - started
+        if marks["ttfb"] is None:
+            marks["ttfb"] = now
+        if event["event"] == "token" and marks["ttft"] is None:
+            marks["ttft"] = now
+
+    await rag.arun_query(query["user_query"], query["type"], query.get("latitude"), query.get("longitude"), sink=sink)
+    return {"latency": time.perf_counter() - started, **marks}
+
+
+async def api_call(client, url, api_key, query):
+    started = time.perf_counter()
+    marks = {"ttfb": None, "ttft": None}
+    body = {**query, "stream": "ndjson"}
+    async with client.stream("POST", f"{url}/ask", json=body, headers={"x-api-key": api_key}) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        async for line in response.aiter_lines():
+            now = time.perf_counter() - started
+            if marks["ttfb"] is None:
+                marks["ttfb"] = now
+            if not line:
+                continue
+            event = json.loads(line)
+            if event["event"] == "token" and marks["ttft"] is None:
+                marks["ttft"] = now
+            if event["event"] == "error":
+                raise RuntimeError(event["error"])
+    return {"latency": time.perf_counter() - started, **marks}
+
+
+async def bench_graph(args, queries):
+    import base_rag as rag
+    for query in queries[:args.warmup]:
+        await graph_call(rag, query)
+    rows = []
+    for concurrency in args.concurrency:
+        samples, errors, elapsed = await drive(lambda q: graph_call(rag, q), queries, concurrency, args.requests)
+        rows.append(summarize(concurrency, samples, errors, elapsed, peak_rss_mb()))
+        print(json.dumps(rows[-1]), file=sys.stderr)
+    return rows
+
+
+def start_server(port, api_key):
+    env = {**os.environ, "API_KEY": api_key, "RAG_WORKER_MODE": "inprocess"}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "base_rag_api:app", "--port", str(port), "--log-level", "warning"],
+        cwd=SCRIPT_DIR, env=env,
+    )
+    import httpx
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("benchmark server exited during startup")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/stats", headers={"x-api-key": api_key}).status_code == 200:
+                return server
+        except httpx.TransportError:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("benchmark server did not start")
+
+
+async def bench_api(args, queries):
+    import httpx
+    server = None
+    url, api_key = args.url, args.api_key
+    if url is None:
+        server = start_server(args.port, api_key)
+        url = f"http://127.0.0.1:{args.port}"
+    try:
+        limits = httpx.Limits(max_connections=max(args.concurrency) + 4)
+        async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+            for query in queries[:args.warmup]:
+                await api_call(client, url, api_key, query)
+            rows = []
+            for concurrency in args.concurrency:
+                samples, errors, elapsed = await drive(lambda q: api_call(client, url, api_key, q), queries, concurrency, args.requests)
+                rows.append(summarize(concurrency, samples, errors, elapsed, peak_rss_mb(server.pid) if server else None))
+                print(json.dumps(rows[-1]), file=sys.stderr)
+            return rows
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SCRIPT_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    with open(args.queries) as f:
+        queries = json.load(f)
+    if args.type:
+        queries = [q for q in queries if q["type"] == args.type]
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rag-bench-")
+    prepare_environment(workdir, args.cache, args.index_size)
+    import fakes
+    rows = asyncio.run(bench_graph(args, queries) if args.target == "graph" else bench_api(args, queries))
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "target": args.target,
+        "cache": args.cache,
+        "query_type": args.type,
+        "latency_model": fakes.latency_model(),
+        "results": rows,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    failed = sum(row["errors"] for row in rows)
+    if failed:
+        sys.exit(f"{failed} request(s) failed")
+
+
+def compare(args):
+    """Print per-concurrency changes of `new` relative to `old` for the headline metrics."""
+    with open(args.old) as f:
+        old = {row["concurrency"]: row for row in json.load(f)["results"]}
+    with open(args.new) as f:
+        new = {row["concurrency"]: row for row in json.load(f)["results"]}
+    metrics = ["latency_p50", "latency_p95", "latency_p99", "ttfb_p50", "ttft_p50", "rps", "peak_rss_mb"]
+    print("concurrency  " + "  ".join(f"{m:>14}" for m in metrics))
+    for concurrency in sorted(set(old) & set(new)):
+        cells = []
+        for m in metrics:
+            a, b = old[concurrency].get(m), new[concurrency].get(m)
+            cells.append(f"{(b - a) / a * 100:+13.1f}%" if a and b is not None else f"{'n/a':>14}")
+        print(f"{concurrency:>11}  " + "  ".join(cells))
+
+
+# Budget for `import base_rag`, enforced by tests/test_import_time.py as well.
+IMPORT_BUDGET_MS = 300
+# Top-level packages base_rag must not import until a client, index or graph is needed.
+DEFERRED_PACKAGES = ("langchain", "langchain_core", "langchain_community", "langchain_ibm", "langgraph", "ibm_watsonx_ai", "faiss", "pydantic", "httpx", "IPython")
+
+
+def import_times(module):
+    """(self_us, cumulative_us, name) for every module imported by `import module` in a fresh interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SCRIPT_DIR, capture_output=True, text=True,
+    )
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return rows
+
+
+def import_summary(module):
+    """(total_ms, deferred packages imported, rows) for `import module` in a fresh interpreter."""
+    rows = import_times(module)
+    total_ms = next(cumulative for _, cumulative, name in rows if name.strip() == module) / 1000
+    loaded = {name.strip().split(".")[0] for _, _, name in rows}
+    return total_ms, sorted(loaded & set(DEFERRED_PACKAGES)), rows
+
+
+def imports(args):
+    total_ms, deferred, rows = import_summary(args.module)
+    print(f"import {args.module}: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    for self_us, cumulative_us, name in sorted(rows, key=lambda row: row[0], reverse=True)[:args.top]:
+        print(f"  {self_us / 1000:8.1f} ms self {cumulative_us / 1000:8.1f} ms cumulative  {name.strip()}")
+    if deferred:
+        print(f"FAIL: imported at load time: {', '.join(deferred)}")
+    if total_ms > args.budget_ms:
+        print("FAIL: import time over budget")
+    if deferred or total_ms > args.budget_ms:
+        sys.exit(1)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="benchmark the pipeline on fake backends")
+    run_parser.add_argument("--target", choices=["graph", "api"], default="graph")
+    run_parser.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 4, 16])
+    run_parser.add_argument("--requests", type=int, default=48, help="requests per concurrency level")
+    run_parser.add_argument("--warmup", type=int, default=2)
+    run_parser.add_argument("--type", type=int, choices=[1, 2], help="only use queries of this type")
+    run_parser.add_argument("--queries", default=QUERIES_PATH)
+    run_parser.add_argument("--cache", action="store_true", help="keep the answer and web caches on")
+    run_parser.add_argument("--index-size", type=int, default=200, help="passages in the seeded index")
+    run_parser.add_argument("--workdir", help="directory for the index and caches (default: fresh temp dir)")
+    run_parser.add_argument("--url", help="benchmark an already running API instead of starting one")
+    run_parser.add_argument("--port", type=int, default=8765)
+    run_parser.add_argument("--api-key", default="bench")
+    run_parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare", help="relative change between two reports")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.set_defaults(func=compare)
+
+    imports_parser = commands.add_parser("imports", help="check the import-time budget of base_rag")
+    imports_parser.add_argument("--module", default="base_rag")
+    imports_parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    imports_parser.add_argument("--top", type=int, default=10, help="slowest modules to list")
+    imports_parser.set_defaults(func=imports)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
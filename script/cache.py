@@ -0,0 +1,261 @@
+import asyncio
+import contextvars
+import functools
+import json
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+def normalize_query(text):
+    """Lower-case, collapse whitespace and drop trailing punctuation so trivial variants share a key."""
+    text = re.sub(r"\s+", " ", str(text or "")).strip().lower()
+    return text.rstrip("?!. ")
+
+
+def location_bucket(latitude, longitude, precision=1.0):
+    """Round a coordinate pair to a grid cell; answers only change meaningfully between regions."""
+    if latitude is None or longitude is None:
+        return "none"
+    return f"{round(latitude / precision) * precision:.2f},{round(longitude / precision) * precision:.2f}"
+
+
+class VectorIndex:
+    """Unit-normalized vectors of one cache scope with their keys, searched by one matrix product."""
+
+    def __init__(self):
+        self.keys = []
+        self.rows = {}  # key -> row
+        self.matrix = None
+        self.created = None
+
+    def put(self, key, vector, created_at):
+        vector = np.asarray(vector, dtype=np.float32)
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.keys)
+            if self.matrix is None:
+                self.matrix = np.zeros((64, len(vector)), dtype=np.float32)
+                self.created = np.zeros(64)
+            elif row == len(self.matrix):
+                self.matrix = np.concatenate([self.matrix, np.zeros_like(self.matrix)])
+                self.created = np.concatenate([self.created, np.zeros_like(self.created)])
+            self.keys.append(key)
+            self.rows[key] = row
+        self.matrix[row] = vector / (np.linalg.norm(vector) + 1e-12)
+        self.created[row] = created_at
+
+    def discard(self, key):
+        row = self.rows.pop(key, None)
+        if row is None:
+            return
+        last = len(self.keys) - 1
+        if row != last:
+            # Move the last row into the gap so the live rows stay contiguous.
+            moved = self.keys[row] = self.keys[last]
+            self.rows[moved] = row
+            self.matrix[row] = self.matrix[last]
+            self.created[row] = self.created[last]
+        self.keys.pop()
+
+    def nearest(self, vector, created_after):
+        """(key, cosine similarity) of the closest vector created after `created_after`, or (None, -1.0)."""
+        n = len(self.keys)
+        if not n:
+            return None, -1.0
+        vector = np.asarray(vector, dtype=np.float32)
+        sims = self.matrix[:n] @ (vector / (np.linalg.norm(vector) + 1e-12))
+        sims[self.created[:n] <= created_after] = -np.inf
+        best = int(np.argmax(sims))
+        if sims[best] == -np.inf:
+            return None, -1.0
+        return self.keys[best], float(sims[best])
+
+
+class SqliteCache:
+    """
+    Persistent key/value cache backed by a single SQLite table.
+
+    Entries expire after `ttl` seconds and the least recently used ones are evicted once
+    the table holds more than `max_entries` rows. Values are stored as JSON; an optional
+    float vector and scope are kept alongside for semantic lookups. The vectors of a scope
+    are loaded into a `VectorIndex` on its first lookup and kept in step with sets and
+    evictions from then on, so nearest-neighbour lookups never rescan the table.
+    """
+
+    def __init__(self, path, table, ttl=86400, max_entries=5000):
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._scopes = {}  # scope -> VectorIndex, for the scopes looked up so far
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"""CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                scope TEXT,
+                value TEXT NOT NULL,
+                vector BLOB,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_scope ON {table} (scope)")
+        self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value FROM {self.table} WHERE key = ? AND created_at > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value, scope=None, vector=None):
+        now = time.time()
+        blob = None if vector is None else np.asarray(vector, dtype=np.float32).tobytes()
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, scope, value, vector, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, scope, json.dumps(value), blob, now, now),
+            )
+            self._forget([key])
+            if vector is not None and scope in self._scopes:
+                self._scopes[scope].put(key, vector, now)
+            self._evict(now)
+            self._conn.commit()
+
+    def nearest(self, scope, vector):
+        """(key, cosine similarity) of the closest unexpired entry in `scope` carrying a vector, or (None, -1.0)."""
+        with self._lock:
+            index = self._scopes.get(scope)
+            if index is None:
+                index = self._scopes[scope] = VectorIndex()
+                rows = self._conn.execute(
+                    f"SELECT key, vector, created_at FROM {self.table} WHERE scope = ? AND vector IS NOT NULL", (scope,)
+                )
+                for key, blob, created_at in rows:
+                    index.put(key, np.frombuffer(blob, dtype=np.float32), created_at)
+            return index.nearest(vector, time.time() - self.ttl)
+
+    def _forget(self, keys):
+        for index in self._scopes.values():
+            for key in keys:
+                index.discard(key)
+
+    def _evict(self, now):
+        expired = [r[0] for r in self._conn.execute(f"SELECT key FROM {self.table} WHERE created_at <= ?", (now - self.ttl,))]
+        self._conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", [(k,) for k in expired])
+        overflow = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0] - self.max_entries
+        evicted = []
+        if overflow > 0:
+            evicted = [r[0] for r in self._conn.execute(
+                f"SELECT key FROM {self.table} ORDER BY accessed_at ASC LIMIT ?", (overflow,)
+            )]
+            self._conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", [(k,) for k in evicted])
+        self._forget(expired + evicted)
+        self.evictions += len(expired) + len(evicted)
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": size}
+
+
+class SemanticCache:
+    """
+    Two-level answer cache.
+
+    Level one is an exact match on the normalized key. Level two embeds the query text
+    and serves the closest cached entry of the same scope whose cosine similarity is at
+    least `threshold`.
+    """
+
+    def __init__(self, store, embeddings, threshold=0.92):
+        self.store = store
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.semantic_hits = 0
+
+    def lookup(self, key, scope, text):
+        """Return (value, vector). `vector` is the query embedding on a miss so `save` can reuse it."""
+        value = self.store.get(key)
+        if value is not None:
+            return value, None
+        vector = self.embeddings.embed_query(text)
+        return self._semantic_match(scope, vector), vector
+
+    def _semantic_match(self, scope, vector):
+        key, similarity = self.store.nearest(scope, vector)
+        if key is not None and similarity >= self.threshold:
+            value = self.store.get(key)
+            if value is not None:
+                # The exact-key miss was already counted; re-book it as a semantic hit.
+                self.store.misses -= 1
+                self.semantic_hits += 1
+                return value
+        return None
+
+    def save(self, key, scope, text, value, vector=None):
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+        self.store.set(key, value, scope=scope, vector=vector)
+
+    async def alookup(self, key, scope, text):
+        """Async `lookup`: the query embedding is awaited and SQLite work runs off the event loop."""
+        value = await asyncio.to_thread(self.store.get, key)
+        if value is not None:
+            return value, None
+        vector = await self.embeddings.aembed_query(text)
+        value = await asyncio.to_thread(self._semantic_match, scope, vector)
+        return value, vector
+
+    async def asave(self, key, scope, text, value, vector=None):
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+        await asyncio.to_thread(self.store.set, key, value, scope, vector)
+
+    def stats(self):
+        return {**self.store.stats(), "semantic_hits": self.semantic_hits}
+
+
+class AsyncSingleFlight:
+    """
+    Collapse concurrent calls for the same key into one, for coroutines on one event loop.
+
+    The first caller starts `coro_fn()` as a task of its own, in an empty context so it
+    does not run under that caller's request deadline or trace, and every caller, that
+    one included, awaits it through `asyncio.shield` for at most its own `timeout`
+    seconds. A caller that is cancelled or times out only stops waiting: the others still
+    get the result, and the call runs to completion so whatever it caches is not wasted.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, coro_fn, timeout=None):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = contextvars.Context().run(asyncio.create_task, coro_fn())
+            task.add_done_callback(functools.partial(self._finished, key))
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+
+    def _finished(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every caller has gone.
+            task.exception()
@@ -0,0 +1,437 @@
+"""
+Process-wide client layer for watsonx and Tavily.
+
+All chains share one watsonx APIClient (one pooled keep-alive HTTP session) and one
+httpx client for Tavily. Every remote call passes through a per-provider token bucket,
+is retried with jittered exponential backoff on 429/5xx/timeouts, and is bounded by a
+per-call timeout that never outlives the deadline of the /ask request it serves.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import queue
+import random
+import threading
+import time
+
+import httpx
+from ibm_watsonx_ai import APIClient, Credentials
+from langchain_ibm import WatsonxEmbeddings, WatsonxLLM
+
+import tracing
+
+# Monotonic deadline of the request being served, set by the API per request.
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class CallAbandoned(TimeoutError):
+    """A blocking call was given up on while still running on its thread."""
+
+
+def set_deadline(seconds):
+    """Bound every remote call made from the current context to `seconds` from now."""
+    return _deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+def call_timeout(default):
+    """Per-call timeout: `default` (None for none), shortened to what is left of the request deadline."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("request deadline exceeded")
+    return left if default is None else min(default, left)
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` per second up to `capacity`; usable from threads and coroutines."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount):
+        """Take `amount` tokens (possibly going negative) and return how long to wait for them."""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, amount=1):
+        wait = self._reserve(amount)
+        if wait:
+            time.sleep(wait)
+
+    async def aacquire(self, amount=1):
+        wait = self._reserve(amount)
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class ProviderLimits:
+    """Request-rate bucket plus an optional tokens-per-minute bucket for one provider."""
+
+    def __init__(self, requests_per_second, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_second, max(1, requests_per_second))
+        self.tokens = TokenBucket(tokens_per_minute / 60.0, tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, tokens=0):
+        self.requests.acquire()
+        if self.tokens and tokens:
+            self.tokens.acquire(tokens)
+
+    async def aacquire(self, tokens=0):
+        await self.requests.aacquire()
+        if self.tokens and tokens:
+            await self.tokens.aacquire(tokens)
+
+
+RETRY_ATTEMPTS = int(os.getenv("CLIENT_RETRY_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("CLIENT_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("CLIENT_RETRY_MAX_DELAY", "8"))
+
+
+def is_retryable(error):
+    if isinstance(error, DeadlineExceeded):
+        return False
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, httpx.TransportError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    text = str(error)
+    return "429" in text or "Too Many Requests" in text or "rate limit" in text.lower()
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff so concurrent retries do not arrive in lockstep."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+async def acall(limits, fn, timeout, tokens=0):
+    """Await `fn()` under `limits` and a deadline-bounded timeout, retrying transient failures."""
+    for attempt in range(RETRY_ATTEMPTS):
+        await limits.aacquire(tokens)
+        try:
+            # Before fn(): a deadline that has already passed must not leave an un-awaited coroutine.
+            limit = call_timeout(timeout)
+            return await asyncio.wait_for(fn(), limit)
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1 or not is_retryable(e):
+                raise
+            tracing.annotate(retries=attempt + 1)
+            await asyncio.sleep(min(backoff_delay(attempt), call_timeout(RETRY_MAX_DELAY)))
+
+
+def run_with_timeout(fn, timeout):
+    """
+    Run blocking `fn()` on a daemon thread, in the caller's context, and stop waiting for
+    it after `timeout` seconds. The SDK calls have no cancellation, so an abandoned call
+    runs on until its own socket timeouts end it; only its result is discarded, and
+    CallAbandoned is raised.
+    """
+    future = concurrent.futures.Future()
+    context = contextvars.copy_context()
+
+    def target():
+        try:
+            future.set_result(context.run(fn))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, name="client-call", daemon=True).start()
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        raise CallAbandoned(f"call did not finish within {timeout:.1f}s") from None
+
+
+def call(limits, fn, timeout, tokens=0):
+    """
+    Blocking variant of `acall` for the synchronous chain paths (e.g. background write-back).
+
+    A call that timed out is not retried: it is still running on its abandoned thread,
+    and a retry would put a second copy of the same request on the wire.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        limits.acquire(tokens)
+        try:
+            return run_with_timeout(fn, call_timeout(timeout))
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1 or isinstance(e, CallAbandoned) or not is_retryable(e):
+                raise
+            tracing.annotate(retries=attempt + 1)
+            time.sleep(min(backoff_delay(attempt), call_timeout(RETRY_MAX_DELAY)))
+
+
+_END = object()
+
+
+def iterate_with_timeout(open_stream, first_timeout, idle_timeout):
+    """
+    Iterate blocking `open_stream()` on a daemon thread, in the caller's context, waiting
+    at most `first_timeout` for the first chunk and `idle_timeout` for each later one,
+    both bounded by the request deadline. Raises CallAbandoned when a wait runs out.
+    """
+    chunks = queue.Queue()
+    context = contextvars.copy_context()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for chunk in open_stream():
+                if stop.is_set():
+                    return
+                chunks.put((chunk, None))
+            chunks.put((_END, None))
+        except BaseException as e:
+            chunks.put((None, e))
+
+    threading.Thread(target=context.run, args=(produce,), name="client-stream", daemon=True).start()
+    timeout = first_timeout
+    try:
+        while True:
+            limit = call_timeout(timeout)
+            try:
+                chunk, error = chunks.get(timeout=limit)
+            except queue.Empty:
+                raise CallAbandoned(f"no stream chunk within {limit:.1f}s") from None
+            if error is not None:
+                raise error
+            if chunk is _END:
+                return
+            yield chunk
+            timeout = idle_timeout
+    finally:
+        stop.set()
+
+
+def stream_call(limits, open_stream, first_timeout, idle_timeout, tokens=0):
+    """
+    Blocking streamed call under `limits`, with `iterate_with_timeout`'s waits. Failures
+    before the first chunk are retried like `call`; once a chunk is out they propagate.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        limits.acquire(tokens)
+        chunks = iterate_with_timeout(open_stream, first_timeout, idle_timeout)
+        try:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            except Exception as e:
+                if attempt == RETRY_ATTEMPTS - 1 or isinstance(e, CallAbandoned) or not is_retryable(e):
+                    raise
+                tracing.annotate(retries=attempt + 1)
+                time.sleep(min(backoff_delay(attempt), call_timeout(RETRY_MAX_DELAY)))
+                continue
+            yield chunk
+            yield from chunks
+            return
+        finally:
+            chunks.close()
+
+
+async def astream_call(limits, open_stream, first_timeout, idle_timeout, tokens=0):
+    """
+    Async streamed call under `limits`: at most `first_timeout` for the first chunk and
+    `idle_timeout` between chunks, both bounded by the request deadline. Failures before
+    the first chunk (a 429, a timeout) are retried like `acall`; later ones propagate.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        await limits.aacquire(tokens)
+        limit = call_timeout(first_timeout)
+        chunks = open_stream()
+        try:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), limit)
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                if attempt == RETRY_ATTEMPTS - 1 or not is_retryable(e):
+                    raise
+                tracing.annotate(retries=attempt + 1)
+                await asyncio.sleep(min(backoff_delay(attempt), call_timeout(RETRY_MAX_DELAY)))
+                continue
+            while True:
+                yield chunk
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), call_timeout(idle_timeout))
+                except StopAsyncIteration:
+                    return
+        finally:
+            await chunks.aclose()
+
+
+def estimate_tokens(texts):
+    # Roughly four characters per token for English text.
+    return sum(len(t) for t in texts) // 4
+
+
+def record_llm_usage(span, prompts, result):
+    """Token counts reported by watsonx when present, estimated from the text otherwise."""
+    usage = (result.llm_output or {}).get("token_usage") or {}
+    span.set(
+        input_tokens=usage.get("input_token_count") or estimate_tokens(prompts),
+        output_tokens=usage.get("generated_token_count") or estimate_tokens(g.text for gens in result.generations for g in gens),
+    )
+
+
+llm_limits = ProviderLimits(
+    float(os.getenv("WATSONX_LLM_RPS", "8")),
+    tokens_per_minute=int(os.getenv("WATSONX_LLM_TPM", "200000")),
+)
+embedding_limits = ProviderLimits(float(os.getenv("WATSONX_EMBED_RPS", "8")))
+search_limits = ProviderLimits(float(os.getenv("TAVILY_RPS", "4")))
+
+LLM_TIMEOUT = float(os.getenv("WATSONX_LLM_TIMEOUT", "120"))
+# Longest pause allowed between two chunks of a streamed generation.
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv("WATSONX_STREAM_IDLE_TIMEOUT", "30"))
+EMBED_TIMEOUT = float(os.getenv("WATSONX_EMBED_TIMEOUT", "20"))
+SEARCH_TIMEOUT = float(os.getenv("TAVILY_TIMEOUT", "20"))
+
+
+class LimitedWatsonxLLM(WatsonxLLM):
+    """WatsonxLLM whose calls go through `llm_limits`, the retry policy and the request deadline."""
+
+    def _generation_tokens(self, prompts):
+        max_new = (self.params or {}).get("max_new_tokens", 0)
+        return estimate_tokens(prompts) + max_new * len(prompts)
+
+    def _generate(self, prompts, *args, **kwargs):
+        parent = super(LimitedWatsonxLLM, self)._generate
+        with tracing.span("llm.generate", model=self.model_id) as span:
+            result = call(llm_limits, lambda: parent(prompts, *args, **kwargs), LLM_TIMEOUT, self._generation_tokens(prompts))
+            record_llm_usage(span, prompts, result)
+            return result
+
+    async def _agenerate(self, prompts, *args, **kwargs):
+        parent = super(LimitedWatsonxLLM, self)._agenerate
+        with tracing.span("llm.generate", model=self.model_id) as span:
+            result = await acall(llm_limits, lambda: parent(prompts, *args, **kwargs), LLM_TIMEOUT, self._generation_tokens(prompts))
+            record_llm_usage(span, prompts, result)
+            return result
+
+    # The stream spans are not made current (tracing.start_span): a contextvar token cannot
+    # be held across `yield` when LangChain drives the generator from copied contexts.
+    # Streams are retried only until the first chunk; after that tokens have been emitted.
+    def _stream(self, prompt, *args, **kwargs):
+        parent = super(LimitedWatsonxLLM, self)._stream
+        span = tracing.start_span("llm.stream", model=self.model_id, input_tokens=estimate_tokens([prompt]))
+        error = None
+        try:
+            chunks = stream_call(
+                llm_limits, lambda: parent(prompt, *args, **kwargs), LLM_TIMEOUT, LLM_STREAM_IDLE_TIMEOUT, self._generation_tokens([prompt])
+            )
+            for chunk in chunks:
+                span.add("output_tokens")
+                yield chunk
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            tracing.end_span(span, error)
+
+    async def _astream(self, prompt, *args, **kwargs):
+        parent = super(LimitedWatsonxLLM, self)._astream
+        span = tracing.start_span("llm.stream", model=self.model_id, input_tokens=estimate_tokens([prompt]))
+        error = None
+        chunks = None
+        try:
+            chunks = astream_call(
+                llm_limits, lambda: parent(prompt, *args, **kwargs), LLM_TIMEOUT, LLM_STREAM_IDLE_TIMEOUT, self._generation_tokens([prompt])
+            )
+            async for chunk in chunks:
+                if "time_to_first_token" not in span.attributes:
+                    span.set(time_to_first_token=(time.time_ns() - span.start_ns) / 1e9)
+                span.add("output_tokens")
+                yield chunk
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if chunks is not None:
+                # Release the upstream stream now, not whenever the generator is collected.
+                await chunks.aclose()
+            tracing.end_span(span, error)
+
+
+class LimitedWatsonxEmbeddings(WatsonxEmbeddings):
+    """WatsonxEmbeddings whose calls go through `embedding_limits` and the retry policy."""
+
+    def embed_documents(self, texts):
+        parent = super(LimitedWatsonxEmbeddings, self).embed_documents
+        with tracing.span("embeddings.embed", texts=len(texts)):
+            return call(embedding_limits, lambda: parent(texts), EMBED_TIMEOUT)
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        parent = super(LimitedWatsonxEmbeddings, self).aembed_documents
+        with tracing.span("embeddings.embed", texts=len(texts)):
+            return await acall(embedding_limits, lambda: parent(texts), EMBED_TIMEOUT)
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+class TavilySearch:
+    """
+    Minimal Tavily search client on a shared, keep-alive httpx connection pool.
+
+    Drop-in for TavilySearchResults as used here: `invoke`/`ainvoke` take {"query": ...}
+    and return a list of {"url", "content"} dicts.
+    """
+
+    URL = "https://api.tavily.com/search"
+
+    def __init__(self, api_key, max_results=5):
+        self.api_key = api_key
+        self.max_results = max_results
+        limits = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+        self._client = httpx.Client(limits=limits)
+        self._aclient = httpx.AsyncClient(limits=limits)
+
+    def _payload(self, query):
+        return {"api_key": self.api_key, "query": query, "max_results": self.max_results, "search_depth": "advanced"}
+
+    @staticmethod
+    def _results(response):
+        response.raise_for_status()
+        return [{"url": r["url"], "content": r["content"]} for r in response.json().get("results", [])]
+
+    def invoke(self, input):
+        with tracing.span("tavily.search"):
+            return call(
+                search_limits,
+                lambda: self._results(self._client.post(self.URL, json=self._payload(input["query"]), timeout=call_timeout(SEARCH_TIMEOUT))),
+                SEARCH_TIMEOUT,
+            )
+
+    async def ainvoke(self, input):
+        async def request():
+            return self._results(await self._aclient.post(self.URL, json=self._payload(input["query"]), timeout=call_timeout(SEARCH_TIMEOUT)))
+        with tracing.span("tavily.search"):
+            return await acall(search_limits, request, SEARCH_TIMEOUT)
+
+
+def watsonx_client(url, api_key, project_id):
+    """One APIClient (and so one pooled HTTP session) shared by every watsonx model."""
+    return APIClient(credentials=Credentials(url=url, api_key=api_key), project_id=project_id)
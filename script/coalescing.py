@@ -0,0 +1,90 @@
+import asyncio
+
+
+class SharedRun:
+    """Events of one pipeline run, replayed in full to every subscriber that attaches to it."""
+
+    def __init__(self):
+        self.events = []
+        self.finished = False
+        self.subscribers = 0
+        self.task = None
+        self._wake = asyncio.Event()
+
+    def publish(self, event):
+        self.events.append(event)
+        self._notify()
+
+    def finish(self):
+        self.finished = True
+        self._notify()
+
+    def _notify(self):
+        wake, self._wake = self._wake, asyncio.Event()
+        wake.set()
+
+
+class RequestCoalescer:
+    """
+    Single-flight for streamed requests.
+
+    The first request for a key starts the run; requests for the same key that arrive
+    while it is in flight attach to it and receive every event from the start, then the
+    rest as they are produced. A subscriber that goes away only detaches itself; the run
+    is cancelled once nobody is left listening.
+    """
+
+    def __init__(self):
+        self._runs = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def running(self, key):
+        return key in self._runs
+
+    def join(self, key, start):
+        """Stream the events of the run for `key`, calling `start()` for an event source if there is none."""
+        run = self._runs.get(key)
+        if run is None:
+            run = self._runs[key] = SharedRun()
+            run.task = asyncio.create_task(self._drive(key, run, start()))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        return self._subscribe(key, run)
+
+    async def _drive(self, key, run, events):
+        try:
+            async for event in events:
+                run.publish(event)
+        finally:
+            if self._runs.get(key) is run:
+                del self._runs[key]
+            run.finish()
+
+    async def _subscribe(self, key, run):
+        run.subscribers += 1
+        try:
+            i = 0
+            while True:
+                while i < len(run.events):
+                    yield run.events[i]
+                    i += 1
+                if run.finished:
+                    return
+                await run._wake.wait()
+        finally:
+            run.subscribers -= 1
+            if not run.subscribers and not run.finished:
+                # Last listener gone: stop spending LLM calls, and let new requests start afresh.
+                if self._runs.get(key) is run:
+                    del self._runs[key]
+                run.task.cancel()
+
+    def stats(self):
+        return {
+            "in_flight": len(self._runs),
+            "subscribers": sum(run.subscribers for run in self._runs.values()),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,107 @@
+"""
+Prompt-size control for the generation steps.
+
+`generate` used to format the raw Document list into its prompt and `consolidate` the
+list of {question: answer} dicts, both as Python reprs and without any bound. The
+functions here drop duplicate sources (same URL, or near-identical text such as a web
+result that was also written back to the index), keep documents in ranked order up to a
+token budget, and render them as compact numbered text. Token counts come from a local
+approximation of the model tokenizer, so packing needs no network call.
+"""
+import os
+import re
+
+import tracing
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_DOC_TOKENS = int(os.getenv("CONTEXT_DOC_TOKENS", "600"))
+CONSOLIDATE_TOKEN_BUDGET = int(os.getenv("CONSOLIDATE_TOKEN_BUDGET", "4000"))
+NEAR_DUPLICATE_SIMILARITY = float(os.getenv("CONTEXT_DEDUP_SIMILARITY", "0.8"))
+
+# Words, numbers and single punctuation marks; long words count as several pieces,
+# which tracks BPE token counts for English text closely enough for budgeting.
+PIECE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text):
+    return sum(1 + len(piece) // 8 for piece in PIECE_PATTERN.findall(text))
+
+
+def truncate(text, max_tokens):
+    """Cut `text` at a word boundary so that it fits `max_tokens`."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    used = 0
+    for match in re.finditer(r"\S+", text):
+        used += count_tokens(match.group())
+        if used > max_tokens:
+            return text[:match.start()].rstrip() + " …"
+    return text
+
+
+def _shingles(text, size=3):
+    words = re.findall(r"\w+", text.lower())
+    return {" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def dedup_documents(documents, similarity=NEAR_DUPLICATE_SIMILARITY):
+    """Drop later documents with an already seen URL or near-identical content (shingle Jaccard)."""
+    kept, urls, shingle_sets = [], set(), []
+    for doc in documents:
+        url = doc.metadata.get("url")
+        if url and url in urls:
+            continue
+        shingles = _shingles(doc.page_content)
+        if any(len(shingles & seen) / len(shingles | seen) >= similarity for seen in shingle_sets):
+            continue
+        if url:
+            urls.add(url)
+        shingle_sets.append(shingles)
+        kept.append(doc)
+    return kept
+
+
+def _fill(entries, budget, per_entry):
+    """Truncate each (header, body) to `per_entry` and stop once `budget` tokens are used."""
+    blocks, used = [], 0
+    for header, body in entries:
+        room = min(per_entry, budget - used - count_tokens(header))
+        if room <= 0:
+            break
+        block = header + truncate(body.strip(), room)
+        blocks.append(block)
+        used += count_tokens(block)
+    return "\n\n".join(blocks)
+
+
+def _record(stage, raw, packed):
+    raw_tokens, packed_tokens = count_tokens(raw), count_tokens(packed)
+    tracing.annotate(context_tokens_raw=raw_tokens, context_tokens_packed=packed_tokens)
+    tracing.metrics.inc("rag_context_tokens_total", raw_tokens, stage=stage, kind="raw")
+    tracing.metrics.inc("rag_context_tokens_total", packed_tokens, stage=stage, kind="packed")
+    root = tracing.root_span()
+    if root is not None:
+        root.add("context_tokens_saved", max(0, raw_tokens - packed_tokens))
+
+
+def pack_documents(documents, budget=CONTEXT_TOKEN_BUDGET, per_document=CONTEXT_DOC_TOKENS):
+    """Deduplicated, budgeted "[n] (url) text" rendering of `documents` in their ranked order."""
+    unique = dedup_documents(documents)
+    entries = []
+    for i, doc in enumerate(unique, 1):
+        url = doc.metadata.get("url")
+        entries.append((f"[{i}] ({url}) " if url else f"[{i}] ", doc.page_content))
+    packed = _fill(entries, budget, per_document)
+    _record("generate", str(documents), packed)
+    return packed
+
+
+def pack_answers(questions, answers, budget=CONSOLIDATE_TOKEN_BUDGET):
+    """Render sub-question/answer pairs as "Q: / A:" blocks sharing `budget` evenly."""
+    pairs = list(zip(questions, answers))
+    if not pairs:
+        return ""
+    entries = [(f"Q: {q}\nA: ", a) for q, a in pairs]
+    packed = _fill(entries, budget, budget // len(pairs))
+    _record("consolidate", str([{q: a.strip()} for q, a in pairs]), packed)
+    return packed
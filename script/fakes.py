@@ -0,0 +1,231 @@
+"""
+Deterministic local stand-ins for the remote services, used by bench.py (RAG_BACKEND=fake).
+
+FakeLLM, FakeEmbeddings and FakeSearch replace LimitedWatsonxLLM, LimitedWatsonxEmbeddings
+and TavilySearch. Outputs are derived from a hash of the input only, so repeated runs see
+identical graph paths. Latency follows a simple model read from the environment:
+
+    FAKE_LLM_LATENCY_MS       time to first token of every LLM call (default 200)
+    FAKE_LLM_TOKENS_PER_S     generation speed after the first token (default 80)
+    FAKE_LLM_RELEVANCE        share of documents the grader marks relevant (default 0.75)
+    FAKE_EMBED_LATENCY_MS     per embedding request (default 30)
+    FAKE_EMBED_PER_TEXT_MS    added per text in a batch (default 1)
+    FAKE_SEARCH_LATENCY_MS    per web search (default 400)
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+from tracing import end_span, span, start_span
+
+
+def _ms(name, default):
+    return float(os.getenv(name, default)) / 1000
+
+
+def _digest(text):
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+
+
+def latency_model():
+    """The configured latency parameters, recorded alongside benchmark results."""
+    return {
+        "llm_latency_ms": float(os.getenv("FAKE_LLM_LATENCY_MS", "200")),
+        "llm_tokens_per_s": float(os.getenv("FAKE_LLM_TOKENS_PER_S", "80")),
+        "llm_relevance": float(os.getenv("FAKE_LLM_RELEVANCE", "0.75")),
+        "embed_latency_ms": float(os.getenv("FAKE_EMBED_LATENCY_MS", "30")),
+        "embed_per_text_ms": float(os.getenv("FAKE_EMBED_PER_TEXT_MS", "1")),
+        "search_latency_ms": float(os.getenv("FAKE_SEARCH_LATENCY_MS", "400")),
+    }
+
+
+TOPICS = [
+    "carbon footprint", "water usage", "recyclability", "packaging waste",
+    "ethical sourcing", "land use", "transport emissions", "end-of-life disposal",
+]
+PRODUCTS = [
+    "chocolate bar", "cotton t-shirt", "smartphone", "plastic water bottle", "beef burger",
+    "oat milk", "paper cup", "electric car battery", "bar of soap", "laptop",
+]
+
+
+def corpus(size=200):
+    """Synthetic knowledge-base passages to seed the benchmark FAISS index."""
+    texts = []
+    for i in range(size):
+        product = PRODUCTS[i % len(PRODUCTS)]
+        topic = TOPICS[(i // len(PRODUCTS)) % len(TOPICS)]
+        texts.append(
+            f"The {topic} of a {product} depends on its raw materials, manufacturing and "
+            f"distribution. Life cycle assessment study {i} reports {(_digest(str(i)) % 900) / 10 + 1} "
+            f"units for the {topic} of a typical {product}."
+        )
+    return texts
+
+
+class FakeLLM(LLM):
+    """
+    Recognises which prompt of base_rag it is serving and answers in the expected shape:
+    grader JSON, decomposition lines, an answer card or markdown prose.
+    """
+
+    latency: float = 0.2
+    tokens_per_second: float = 80.0
+    relevance: float = 0.75
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            latency=_ms("FAKE_LLM_LATENCY_MS", "200"),
+            tokens_per_second=float(os.getenv("FAKE_LLM_TOKENS_PER_S", "80")),
+            relevance=float(os.getenv("FAKE_LLM_RELEVANCE", "0.75")),
+        )
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _respond(self, prompt):
+        seed = _digest(prompt)
+        if "binary score 'yes' or 'no'" in prompt:
+            return json.dumps({"score": "yes" if (seed % 1000) / 1000 < self.relevance else "no"})
+        if "Decompositions:" in prompt:
+            question = prompt.rsplit("Question:", 1)[-1].split("<|eot_id|>", 1)[0].strip()
+            if re.search(r"\btype\s*:\s*1\b", prompt):
+                return question
+            parts = [p.strip(" ?.") for p in re.split(r"\band\b|\bcompared to\b|\bvs\.?\b|,", question) if p.strip(" ?.")]
+            return "\n".join(f"What is the environmental impact of {p}?" for p in parts[:4]) or question
+        if "return a JSON object" in prompt:
+            return json.dumps({
+                "rating": seed % 101,
+                "text": self._prose(seed, 60),
+                "citations": [{"label": "UNEP", "url": "https://www.unep.org/resources"}],
+                "recommendations": [{"text": "Buy products with recycled packaging."}, {"text": "Reuse the item where you can."}],
+                "suggestedQuestions": ["What is its water usage?", "Is it recyclable?", "How is it transported?"],
+            }, indent=2)
+        return self._prose(seed, 120)
+
+    @staticmethod
+    def _prose(seed, words):
+        vocabulary = ["emissions", "lifecycle", "water", "energy", "waste", "sourcing", "transport", "recycling", "impact", "footprint"]
+        return " ".join(vocabulary[(seed >> (i % 48)) % len(vocabulary)] for i in range(words)) + "."
+
+    @staticmethod
+    def _tokens(text):
+        return re.findall(r"\S+\s*", text) or [text]
+
+    def _generation_time(self, text):
+        return self.latency + len(self._tokens(text)) / self.tokens_per_second
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        text = self._respond(prompt)
+        with span("llm.generate", model="fake", output_tokens=len(self._tokens(text))):
+            time.sleep(self._generation_time(text))
+        return text
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        text = self._respond(prompt)
+        with span("llm.generate", model="fake", output_tokens=len(self._tokens(text))):
+            await asyncio.sleep(self._generation_time(text))
+        return text
+
+    # Like LimitedWatsonxLLM, the stream spans are opened with start_span because a
+    # contextvar token cannot be held across `yield` in a LangChain-driven stream.
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        s = start_span("llm.stream", model="fake")
+        error = None
+        try:
+            time.sleep(self.latency)
+            for token in self._tokens(self._respond(prompt)):
+                s.add("output_tokens")
+                yield GenerationChunk(text=token)
+                time.sleep(1 / self.tokens_per_second)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            end_span(s, error)
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[GenerationChunk]:
+        s = start_span("llm.stream", model="fake")
+        error = None
+        try:
+            await asyncio.sleep(self.latency)
+            for token in self._tokens(self._respond(prompt)):
+                s.add("output_tokens")
+                yield GenerationChunk(text=token)
+                await asyncio.sleep(1 / self.tokens_per_second)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            end_span(s, error)
+
+
+class FakeEmbeddings(Embeddings):
+    """Unit vectors seeded from the text hash; a per-request plus per-text delay."""
+
+    def __init__(self, dimension=384, latency=None, per_text=None):
+        self.dimension = dimension
+        self.latency = _ms("FAKE_EMBED_LATENCY_MS", "30") if latency is None else latency
+        self.per_text = _ms("FAKE_EMBED_PER_TEXT_MS", "1") if per_text is None else per_text
+
+    def _vector(self, text):
+        vector = np.random.default_rng(_digest(text)).standard_normal(self.dimension)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        with span("embeddings.embed", texts=len(texts)):
+            time.sleep(self.latency + self.per_text * len(texts))
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        with span("embeddings.embed", texts=len(texts)):
+            await asyncio.sleep(self.latency + self.per_text * len(texts))
+        return [self._vector(t) for t in texts]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+class FakeSearch:
+    """Same interface as clients.TavilySearch, returning synthetic trusted-site results."""
+
+    SITES = ["unep.org", "ipcc.ch", "ecoinvent.org", "openlca.org", "world.openfoodfacts.org"]
+
+    def __init__(self, max_results=5, latency=None):
+        self.max_results = max_results
+        self.latency = _ms("FAKE_SEARCH_LATENCY_MS", "400") if latency is None else latency
+
+    def _results(self, query):
+        question = query.split(" site:", 1)[0]
+        seed = _digest(question)
+        return [
+            {
+                "url": f"https://{self.SITES[(seed + i) % len(self.SITES)]}/report/{(seed >> i) % 10000}",
+                "content": f"Search result {i} for '{question}': " + FakeLLM._prose(seed + i, 40),
+            }
+            for i in range(self.max_results)
+        ]
+
+    def invoke(self, input):
+        with span("tavily.search"):
+            time.sleep(self.latency)
+        return self._results(input["query"])
+
+    async def ainvoke(self, input):
+        with span("tavily.search"):
+            await asyncio.sleep(self.latency)
+        return self._results(input["query"])
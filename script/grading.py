@@ -0,0 +1,123 @@
+"""
+Score-aware relevance grading.
+
+Retrieved chunks carry the dense similarity of the FAISS hit in
+metadata["relevance_score"] (0-1, higher is closer). Chunks scoring at or above the
+accept threshold count as relevant and chunks below the reject threshold count as
+irrelevant, both without an LLM call. Only the band in between is sent to the
+retrieval grader. The thresholds come from grader_thresholds.json (written by the
+calibrate command below) and can be overridden with GRADER_ACCEPT_SCORE and
+GRADER_REJECT_SCORE. With neither set, every chunk is graded.
+
+Set GRADER_LOG_PATH to append each grader verdict with its score as JSON lines, then
+fit thresholds that keep the skipped decisions at the target agreement with the grader:
+
+    python grading.py calibrate --log grader_verdicts.jsonl --precision 0.95
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+THRESHOLDS_PATH = os.getenv("GRADER_THRESHOLDS_PATH", "grader_thresholds.json")
+
+
+class GraderThresholds:
+    def __init__(self, accept=None, reject=None):
+        self.accept = accept
+        self.reject = reject
+
+    @classmethod
+    def load(cls, path=THRESHOLDS_PATH):
+        values = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                values = json.load(f)
+        accept = os.getenv("GRADER_ACCEPT_SCORE", values.get("accept"))
+        reject = os.getenv("GRADER_REJECT_SCORE", values.get("reject"))
+        return cls(
+            float(accept) if accept not in (None, "") else None,
+            float(reject) if reject not in (None, "") else None,
+        )
+
+    def decide(self, score):
+        """"yes" / "no" when the score alone is decisive, None when the grader should decide."""
+        if score is None:
+            return None
+        if self.accept is not None and score >= self.accept:
+            return "yes"
+        if self.reject is not None and score < self.reject:
+            return "no"
+        return None
+
+
+class VerdictLog:
+    """Appends (score, verdict) records for calibration; a no-op when `path` is unset."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, records):
+        if not self.path or not records:
+            return
+        lines = "".join(json.dumps({"ts": time.time(), **r}) + "\n" for r in records)
+        with self._lock, open(self.path, "a") as f:
+            f.write(lines)
+
+
+def calibrate(records, precision=0.95, min_support=20):
+    """
+    Widest thresholds whose skipped decisions agree with the grader at `precision`.
+
+    The accept threshold is the lowest score s such that records scoring >= s were
+    graded "yes" at least `precision` of the time; the reject threshold is the highest
+    s such that records scoring < s were graded "no" at least as often. Each side needs
+    `min_support` records behind it, otherwise it stays unset.
+    """
+    scored = sorted((r["score"], r["verdict"] == "yes") for r in records if r.get("score") is not None)
+    n = len(scored)
+    accept = reject = None
+    yes_above = 0
+    for i in range(n - 1, -1, -1):
+        yes_above += scored[i][1]
+        support = n - i
+        if support >= min_support and yes_above / support >= precision and i > 0 and scored[i - 1][0] < scored[i][0]:
+            accept = scored[i][0]
+    no_below = 0
+    for i in range(n):
+        no_below += not scored[i][1]
+        support = i + 1
+        if support >= min_support and no_below / support >= precision and i < n - 1 and scored[i + 1][0] > scored[i][0]:
+            reject = scored[i + 1][0]
+    if accept is not None and reject is not None and reject > accept:
+        accept = reject = None
+    skipped = sum(1 for s, _ in scored if (accept is not None and s >= accept) or (reject is not None and s < reject))
+    return {
+        "accept": accept,
+        "reject": reject,
+        "precision": precision,
+        "samples": n,
+        "skip_rate": skipped / n if n else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["calibrate"])
+    parser.add_argument("--log", default=os.getenv("GRADER_LOG_PATH", "grader_verdicts.jsonl"))
+    parser.add_argument("--precision", type=float, default=0.95, help="required agreement with the grader")
+    parser.add_argument("--min-support", type=int, default=20)
+    parser.add_argument("--out", default=THRESHOLDS_PATH)
+    args = parser.parse_args(argv)
+    with open(args.log) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    result = calibrate(records, args.precision, args.min_support)
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Offline ingestion of large LCA / climate corpora into the FAISS index.
+
+Streams JSONL, CSV and plain-text files (or directories of them) record by record,
+chunks the text, embeds chunks in batches and writes the result as FAISS shards. A
+checkpoint file records how far every source file got, so an interrupted run resumes
+where it stopped. `--merge` folds the shards into the serving index.
+
+    python ingest.py data/openfoodfacts.jsonl data/ipcc_txt/ --text-field text --url-field url
+    python ingest.py --merge
+"""
+import argparse
+import csv
+import importlib
+import json
+import os
+import sys
+import time
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+
+from knowledge_base import IndexBusy, IndexLock, KnowledgeBase, content_hash
+
+TEXT_EXTENSIONS = (".txt", ".md")
+
+
+def iter_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in sorted(os.walk(path)):
+                for name in sorted(files):
+                    if name.endswith((".jsonl", ".csv") + TEXT_EXTENSIONS):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def iter_records(path, text_field, url_field):
+    """Yield (record_no, text, metadata) for one file without reading it whole."""
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                if line.strip():
+                    row = json.loads(line)
+                    yield i, row.get(text_field) or "", {"source": path, "url": row.get(url_field)}
+    elif path.endswith(".csv"):
+        csv.field_size_limit(sys.maxsize)
+        with open(path, encoding="utf-8", newline="") as f:
+            for i, row in enumerate(csv.DictReader(f)):
+                yield i, row.get(text_field) or "", {"source": path, "url": row.get(url_field)}
+    else:
+        # Plain text: one record per blank-line separated block.
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            block, i = [], 0
+            for line in f:
+                if line.strip():
+                    block.append(line)
+                elif block:
+                    yield i, "".join(block), {"source": path}
+                    block, i = [], i + 1
+            if block:
+                yield i, "".join(block), {"source": path}
+
+
+def load_embedder(spec):
+    """Resolve "module:attribute" to an object implementing embed_documents/embed_query."""
+    module, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module), attr or "embeddings")
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.state = {"files": {}, "shards": []}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def done_records(self, source):
+        return self.state["files"].get(source, -1)
+
+    def commit(self, progress, shard):
+        self.state["files"].update(progress)
+        self.state["shards"].append(shard)
+        self.save()
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+
+def ingest(args):
+    embedder = load_embedder(args.embedder)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    os.makedirs(args.shard_dir, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(args.shard_dir, "checkpoint.json"))
+
+    pending, progress = [], {}
+    docs_done = chunks_done = 0
+    started = last_report = time.time()
+
+    def flush_shard():
+        nonlocal pending, progress
+        if not pending:
+            return
+        texts, metadatas = [], []
+        vectors = []
+        for start in range(0, len(pending), args.batch_size):
+            batch = pending[start:start + args.batch_size]
+            vectors.extend(embedder.embed_documents([d.page_content for d in batch]))
+            texts.extend(d.page_content for d in batch)
+            metadatas.extend(d.metadata for d in batch)
+        shard = os.path.join(args.shard_dir, f"shard_{len(checkpoint.state['shards']):05d}")
+        FAISS.from_embeddings(list(zip(texts, vectors)), embedder, metadatas=metadatas).save_local(shard)
+        checkpoint.commit(progress, shard)
+        pending, progress = [], {}
+
+    for source in iter_files(args.paths):
+        resume_after = checkpoint.done_records(source)
+        for record_no, text, metadata in iter_records(source, args.text_field, args.url_field):
+            if record_no <= resume_after or not text.strip():
+                continue
+            metadata = {k: v for k, v in metadata.items() if v is not None}
+            for chunk in splitter.split_text(text):
+                pending.append(Document(page_content=chunk, metadata={**metadata, "content_hash": content_hash(chunk)}))
+            progress[source] = record_no
+            docs_done += 1
+            if len(pending) >= args.shard_size:
+                chunks_done += len(pending)
+                flush_shard()
+            if time.time() - last_report >= args.report_every:
+                last_report = time.time()
+                elapsed = last_report - started
+                print(f"---Ingested {docs_done} docs ({docs_done / elapsed:.1f} docs/sec, {chunks_done / elapsed:.1f} chunks/sec)---", flush=True)
+    chunks_done += len(pending)
+    flush_shard()
+
+    elapsed = max(time.time() - started, 1e-9)
+    print(f"---Done: {docs_done} docs, {chunks_done} chunks in {elapsed:.1f}s ({docs_done / elapsed:.1f} docs/sec)---", flush=True)
+
+
+def merge(args):
+    """
+    Fold the not yet merged shards into the serving index and swap it in atomically.
+
+    Refuses to run while a server with write-back enabled holds the index lock: its next
+    save would otherwise replace the merged index with its own in-memory copy.
+    """
+    try:
+        lock = IndexLock(args.index).acquire(exclusive=True, blocking=False)
+    except IndexBusy:
+        sys.exit(f"{args.index} is in use by a server with write-back enabled; stop it or set KB_WRITEBACK=off, then merge again")
+    try:
+        _merge(args)
+    finally:
+        lock.release()
+
+
+def _merge(args):
+    embedder = load_embedder(args.embedder)
+    checkpoint = Checkpoint(os.path.join(args.shard_dir, "checkpoint.json"))
+    merged = checkpoint.state.setdefault("merged", [])
+    shards = [s for s in checkpoint.state["shards"] if s not in merged]
+    if not shards:
+        print("---Nothing to merge---", flush=True)
+        return
+    vectorstore = None
+    if os.path.exists(args.index):
+        vectorstore = FAISS.load_local(args.index, embedder, allow_dangerous_deserialization=True)
+    for shard in shards:
+        shard_store = FAISS.load_local(shard, embedder, allow_dangerous_deserialization=True)
+        if vectorstore is None:
+            vectorstore = shard_store
+        else:
+            vectorstore.merge_from(shard_store)
+        print(f"---Merged {shard}---", flush=True)
+    previous = os.path.realpath(args.index) if os.path.exists(args.index) else None
+    KnowledgeBase(vectorstore, args.index, embedder).save(force=True)
+    merged.extend(shards)
+    checkpoint.save()
+    if previous:
+        print(f"---Previous index kept at {previous}---", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="JSONL/CSV/text files or directories to ingest")
+    parser.add_argument("--merge", action="store_true", help="merge checkpointed shards into --index and exit")
+    parser.add_argument("--index", default="faiss_index")
+    parser.add_argument("--shard-dir", default="faiss_shards")
+    parser.add_argument("--embedder", default="base_rag:embeddings", help="module:attribute of the embeddings object")
+    parser.add_argument("--text-field", default="text")
+    parser.add_argument("--url-field", default="url")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=32, help="chunks per embedding request")
+    parser.add_argument("--shard-size", type=int, default=5000, help="chunks per FAISS shard / checkpoint")
+    parser.add_argument("--report-every", type=float, default=10.0, help="seconds between throughput reports")
+    args = parser.parse_args(argv)
+
+    if args.merge:
+        merge(args)
+    elif args.paths:
+        ingest(args)
+    else:
+        parser.error("give paths to ingest or --merge")
+
+
+if __name__ == "__main__":
+    main()
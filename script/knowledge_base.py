@@ -0,0 +1,223 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+from lexical_index import BM25Index, HybridRetriever
+
+
+def content_hash(text):
+    return hashlib.sha1(" ".join(text.split()).lower().encode("utf-8")).hexdigest()
+
+
+class ReadWriteLock:
+    """Many concurrent readers or one writer. Writers are preferred so adds cannot starve."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class IndexBusy(RuntimeError):
+    pass
+
+
+class IndexLock:
+    """
+    Advisory lock on `<index>.lock`. Serving processes that write back hold it shared for
+    their lifetime; `ingest.py --merge` takes it exclusively, so the two never overlap.
+    """
+
+    def __init__(self, path):
+        self.path = f"{path}.lock"
+        self._fd = None
+
+    def acquire(self, exclusive=False, blocking=True):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(fd, flags if blocking else flags | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise IndexBusy(f"{self.path} is held by another process") from None
+        self._fd = fd
+        return self
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class KnowledgeBase:
+    """
+    Wraps the FAISS vectorstore so that accepted web results can be written back into it.
+
+    Documents are deduplicated by URL and by a hash of their normalized content (which is
+    also used as the docstore id), embedded in batches and added under a write lock while
+    searches hold the read lock. Written-back documents carry an `added_at` timestamp; once
+    the store holds more than `max_documents` of them the oldest are evicted. Saves happen
+    at most every `save_interval` seconds and swap a symlink to a freshly written
+    directory, so a concurrent `FAISS.load_local` never sees a half-written index. Only
+    version directories written by this instance are ever deleted, and a save is refused
+    once the symlink points somewhere else than this instance last left it (another
+    process swapped in a new index); the in-memory additions are then kept until restart.
+
+    A BM25 index over the same documents is kept in step with the vectorstore and saved
+    into the same directory.
+    """
+
+    def __init__(self, vectorstore, path, embeddings, max_documents=50000, save_interval=300, batch_size=16):
+        self.vectorstore = vectorstore
+        self.path = path
+        self.embeddings = embeddings
+        self.max_documents = max_documents
+        self.save_interval = save_interval
+        self.batch_size = batch_size
+        self.lock = ReadWriteLock()
+        self._dirty = False
+        self._last_save = time.time()
+        self._seen_urls = set()
+        self._seen_hashes = set()
+        self._written_back = {}  # docstore id -> added_at
+        self._seen_keys = {}  # written-back docstore id -> (content hash, url), to forget on eviction
+        self._written_versions = set()
+        self._target = os.path.realpath(path)
+        self._stale = False
+        if os.path.exists(os.path.join(path, BM25Index.FILENAME)):
+            self.lexical = BM25Index.load(path)
+            # The vectorstore may have changed without the saved index (ingest --merge
+            # folding in shards, or an index written by an older version): catch up.
+            self._dirty = self.lexical.sync(vectorstore.docstore) > 0
+        else:
+            self.lexical = BM25Index.from_docstore(vectorstore.docstore)
+        for doc_id, doc in vectorstore.docstore._dict.items():
+            h = content_hash(doc.page_content)
+            self._seen_hashes.add(h)
+            if doc.metadata.get("url"):
+                self._seen_urls.add(doc.metadata["url"])
+            if "added_at" in doc.metadata:
+                self._written_back[doc_id] = doc.metadata["added_at"]
+                self._seen_keys[doc_id] = (h, doc.metadata.get("url"))
+
+    def as_retriever(self, k=4, fetch_k=20):
+        """Retriever fusing dense and BM25 results under this knowledge base's read lock."""
+        return HybridRetriever(vectorstore=self.vectorstore, lexical=self.lexical, lock=self.lock, k=k, fetch_k=fetch_k)
+
+    def is_new(self, doc):
+        return doc.metadata.get("url") not in self._seen_urls and content_hash(doc.page_content) not in self._seen_hashes
+
+    def add_documents(self, documents):
+        """Embed and add the documents not already in the index. Returns the number added."""
+        fresh, batch_hashes = [], set()
+        for doc in documents:
+            h = content_hash(doc.page_content)
+            if self.is_new(doc) and h not in batch_hashes:
+                batch_hashes.add(h)
+                fresh.append((h, doc))
+        if not fresh:
+            return 0
+
+        now = time.time()
+        for start in range(0, len(fresh), self.batch_size):
+            batch = fresh[start:start + self.batch_size]
+            texts = [doc.page_content for _, doc in batch]
+            vectors = self.embeddings.embed_documents(texts)
+            metadatas = [{**doc.metadata, "added_at": now} for _, doc in batch]
+            ids = [h for h, _ in batch]
+            with self.lock.write():
+                self.vectorstore.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+                for h, text in zip(ids, texts):
+                    self.lexical.add(h, text)
+                for h, doc in batch:
+                    self._seen_hashes.add(h)
+                    if doc.metadata.get("url"):
+                        self._seen_urls.add(doc.metadata["url"])
+                    self._written_back[h] = now
+                    self._seen_keys[h] = (h, doc.metadata.get("url"))
+                self._evict()
+                self._dirty = True
+
+        if time.time() - self._last_save >= self.save_interval:
+            self.save()
+        return len(fresh)
+
+    def _evict(self):
+        overflow = len(self._written_back) - self.max_documents
+        if overflow <= 0:
+            return
+        oldest = sorted(self._written_back, key=self._written_back.get)[:overflow]
+        try:
+            self.vectorstore.delete(oldest)
+        except RuntimeError:
+            # HNSW indexes cannot remove vectors; keep growing rather than fail the add.
+            return
+        for doc_id in oldest:
+            del self._written_back[doc_id]
+            self.lexical.remove(doc_id)
+            # Let a later search write the document back again.
+            h, url = self._seen_keys.pop(doc_id, (None, None))
+            self._seen_hashes.discard(h)
+            self._seen_urls.discard(url)
+
+    def save(self, force=False):
+        if not (self._dirty or force) or self._stale:
+            return
+        if os.path.realpath(self.path) != self._target:
+            self._stale = True
+            print(f"---{self.path} was replaced by another process; not saving write-backs over it---", flush=True)
+            return
+        version_dir = f"{self.path}.v{int(time.time() * 1000)}"
+        with self.lock.read():
+            self.vectorstore.save_local(version_dir)
+            self.lexical.save(version_dir)
+            self._dirty = False
+        self._last_save = time.time()
+
+        if os.path.isdir(self.path) and not os.path.islink(self.path):
+            # First write-back on a plain directory: keep it as the initial version.
+            os.replace(self.path, f"{self.path}.v0")
+            os.symlink(os.path.basename(f"{self.path}.v0"), self.path)
+        previous = os.path.realpath(self.path) if os.path.islink(self.path) else None
+        tmp_link = f"{self.path}.tmp-{os.getpid()}"
+        os.symlink(os.path.basename(version_dir), tmp_link)
+        os.replace(tmp_link, self.path)
+        self._target = os.path.realpath(version_dir)
+        self._written_versions.add(self._target)
+        if previous in self._written_versions and previous != self._target:
+            self._written_versions.discard(previous)
+            shutil.rmtree(previous, ignore_errors=True)
@@ -0,0 +1,103 @@
+import json
+import re
+import threading
+
+from pydantic import BaseModel, Field, ValidationError
+
+
+class Citation(BaseModel):
+    label: str
+    url: str
+
+
+class Recommendation(BaseModel):
+    text: str
+
+
+class EnvironmentalAssessment(BaseModel):
+    """Schema of the type 1 answer card rendered by the frontend."""
+
+    rating: float = Field(ge=0, le=100)
+    text: str
+    citations: list[Citation] = Field(min_length=1)
+    recommendations: list[Recommendation]
+    suggestedQuestions: list[str]
+
+
+def repair_json(text):
+    """
+    Best-effort local clean-up of LLM JSON: drops code fences and surrounding prose, smart
+    quotes and trailing commas, and closes brackets left open by a truncated generation.
+    """
+    text = text.strip()
+    fenced = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find("{")
+    if start == -1:
+        return text
+    text = text[start:]
+    end = text.rfind("}")
+    if end != -1 and _is_balanced(text[:end + 1]):
+        text = text[:end + 1]
+    text = text.replace("“", '"').replace("”", '"').replace("’", "'")
+    text = re.sub(r",\s*([}\]])", r"\1", text)
+    return _close_open_brackets(text)
+
+
+def _is_balanced(text):
+    stack, in_string = _open_brackets(text)
+    return not stack and not in_string
+
+
+def _open_brackets(text):
+    stack, in_string, escaped = [], False, False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append(ch)
+        elif ch in "}]" and stack:
+            stack.pop()
+    return stack, in_string
+
+
+def _close_open_brackets(text):
+    stack, in_string = _open_brackets(text)
+    if in_string:
+        text += '"'
+    return text + "".join("}" if ch == "{" else "]" for ch in reversed(stack))
+
+
+def parse_assessment(text):
+    """Parse and validate an answer card, repairing it locally first if needed. Raises ValueError."""
+    for candidate in (text, repair_json(text)):
+        try:
+            return EnvironmentalAssessment.model_validate(json.loads(candidate)).model_dump()
+        except (json.JSONDecodeError, ValidationError, TypeError):
+            continue
+    raise ValueError("LLM output does not match the answer card schema")
+
+
+class StructuredOutputStats:
+    """Counts how type 1 answers were obtained, to track what the fallback retry costs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"single_pass": 0, "retried": 0, "failed": 0}
+
+    def record(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def snapshot(self):
+        with self._lock:
+            total = sum(self.counts.values())
+            return {**self.counts, "retry_rate": (self.counts["retried"] + self.counts["failed"]) / total if total else 0.0}
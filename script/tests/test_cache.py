@@ -0,0 +1,64 @@
+import random
+
+import numpy as np
+import pytest
+
+from cache import SqliteCache, VectorIndex
+
+
+def brute_force_nearest(entries, vector, created_after):
+    """The old full rescan: closest unexpired vector by cosine similarity."""
+    vector = np.asarray(vector, dtype=np.float32)
+    best_key, best = None, -1.0
+    for key, (stored, created_at) in entries.items():
+        if created_at <= created_after:
+            continue
+        similarity = float(stored @ vector / (np.linalg.norm(stored) * np.linalg.norm(vector) + 1e-12))
+        if best_key is None or similarity > best:
+            best_key, best = key, similarity
+    return best_key, best
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_vector_index_matches_rescan_over_random_updates(seed):
+    rng = np.random.default_rng(seed)
+    index, entries = VectorIndex(), {}
+    for step in range(1500):
+        op = rng.random()
+        if op < 0.5 or not entries:
+            key = f"k{rng.integers(300)}"  # sometimes overwrites an existing key
+            vector = rng.normal(size=16).astype(np.float32)
+            index.put(key, vector, float(step))
+            entries[key] = (vector, float(step))
+        elif op < 0.7:
+            key = rng.choice(list(entries))
+            index.discard(key)
+            del entries[key]
+        else:
+            query = rng.normal(size=16)
+            created_after = float(rng.integers(-1, step + 1))
+            key, similarity = index.nearest(query, created_after)
+            expected_key, expected = brute_force_nearest(entries, query, created_after)
+            assert key == expected_key
+            if key is not None:
+                assert similarity == pytest.approx(expected, abs=1e-5)
+        assert sorted(index.keys) == sorted(entries)
+
+
+def test_semantic_lookup_follows_sets_and_evictions(tmp_path):
+    cache = SqliteCache(str(tmp_path / "cache.sqlite"), "answers", ttl=3600, max_entries=20)
+    rng = random.Random(0)
+    vectors = {}
+    for i in range(60):
+        vector = [rng.gauss(0, 1) for _ in range(8)]
+        cache.set(f"k{i}", {"answer": i}, scope="s", vector=vector)
+        vectors[f"k{i}"] = vector
+        if i % 7 == 0:
+            # Loads the scope's index, which later sets and evictions must keep current.
+            cache.nearest("s", vector)
+    live = {row[0] for row in cache._conn.execute("SELECT key FROM answers")}
+    assert len(live) == 20
+    for key in live:
+        assert cache.nearest("s", vectors[key]) == (key, pytest.approx(1.0, abs=1e-5))
+    for key in vectors.keys() - live:
+        assert cache.nearest("s", vectors[key])[0] in live
@@ -0,0 +1,12 @@
+import bench
+
+
+def test_base_rag_defers_heavy_imports():
+    _, deferred, _ = bench.import_summary("base_rag")
+    assert not deferred, f"imported at load time: {', '.join(deferred)}"
+
+
+def test_base_rag_import_within_budget():
+    # Best of three, so a cold page cache on the first run does not fail the budget.
+    total_ms = min(bench.import_summary("base_rag")[0] for _ in range(3))
+    assert total_ms <= bench.IMPORT_BUDGET_MS, f"import base_rag took {total_ms:.1f} ms (budget {bench.IMPORT_BUDGET_MS} ms)"
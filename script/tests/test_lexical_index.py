@@ -0,0 +1,68 @@
+import math
+import random
+
+import pytest
+
+from lexical_index import BM25Index, tokenize
+
+VOCABULARY = [f"term{i}" for i in range(60)]
+
+
+def brute_force_scores(index, query):
+    """Exact BM25 of every document, straight from the index's own term counts."""
+    n = len(index.doc_terms)
+    avg_len = index.total_length / n
+    scores = {}
+    for term in set(tokenize(query)):
+        docs = index.postings.get(term, {})
+        idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+        for doc_id, tf in docs.items():
+            norm = 1 - index.b + index.b * index.doc_len[doc_id] / avg_len
+            scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (index.k1 + 1) / (tf + index.k1 * norm)
+    return scores
+
+
+def random_text(rng):
+    # Zipf-like term frequencies, so that MaxScore pruning actually skips terms.
+    weights = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+    return " ".join(rng.choices(VOCABULARY, weights, k=rng.randint(3, 30)))
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_search_matches_brute_force_over_random_updates(seed):
+    rng = random.Random(seed)
+    index = BM25Index()
+    next_id = 0
+    for _ in range(1000):
+        op = rng.random()
+        if op < 0.45 or not index.doc_terms:
+            index.add(f"doc{next_id}", random_text(rng))
+            next_id += 1
+        elif op < 0.6:
+            index.remove(rng.choice(list(index.doc_terms)))
+        elif op < 0.65:
+            # Re-adding an existing id replaces its text.
+            index.add(rng.choice(list(index.doc_terms)), random_text(rng))
+        else:
+            query = " ".join(rng.sample(VOCABULARY, rng.randint(1, 6)))
+            k = rng.randint(1, 10)
+            expected = brute_force_scores(index, query)
+            results = index.search(query, k)
+            best = sorted(expected.values(), reverse=True)[:k]
+            assert [score for _, score in results] == pytest.approx(best)
+            for doc_id, score in results:
+                assert score == pytest.approx(expected[doc_id])
+
+
+def test_save_and_load_round_trip(tmp_path):
+    rng = random.Random(0)
+    index = BM25Index()
+    for i in range(200):
+        index.add(f"doc{i}", random_text(rng))
+    index.save(tmp_path)
+    loaded = BM25Index.load(tmp_path)
+    query = "term0 term3 term17"
+    expected = index.search(query, 10)
+    results = loaded.search(query, 10)
+    assert [doc_id for doc_id, _ in results] == [doc_id for doc_id, _ in expected]
+    assert [score for _, score in results] == pytest.approx([score for _, score in expected])
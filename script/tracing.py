@@ -0,0 +1,222 @@
+"""
+Timing spans for the nested CRAG pipeline.
+
+A trace is opened per request; spans for graph nodes, sub-question branches and every
+LLM / embedding / search call nest under it through a contextvar, so parents stay
+correct across asyncio tasks. Finished spans feed the Prometheus-style `metrics`
+(see Metrics.render), and when RAG_TRACE_DIR is set each finished trace is also written
+there as OpenTelemetry (OTLP/JSON) compatible JSON.
+"""
+import contextvars
+import functools
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+TRACE_DIR = os.getenv("RAG_TRACE_DIR")
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace, parent, attributes):
+        self.name = name
+        self.trace = trace
+        self.parent = parent
+        self.span_id = secrets.token_hex(8)
+        self.attributes = dict(attributes)
+        self.status = "ok"
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self._started = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key, amount=1):
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+        self.end_ns = time.time_ns()
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def root_span():
+    """The request-level span at the top of the current trace, if any."""
+    span = _current_span.get()
+    while span is not None and span.parent is not None:
+        span = span.parent
+    return span
+
+
+def annotate(**attributes):
+    """Set attributes on the innermost open span, if any."""
+    span = _current_span.get()
+    if span is not None:
+        span.set(**attributes)
+
+
+def start_span(name, **attributes):
+    """
+    Open a child span of the current one without making it current; close it with end_span.
+
+    Use this instead of `span` around a `yield` in async generators: LangChain runs each
+    step of a streamed chain in a copied context, so a contextvar token set before the
+    `yield` cannot be reset after it.
+    """
+    parent = _current_span.get()
+    return Span(name, parent.trace if parent else Trace(), parent, attributes)
+
+
+def end_span(s, error=None):
+    if error is not None and not isinstance(error, GeneratorExit):
+        s.status = "error"
+        s.set(error=type(error).__name__)
+    s.finish()
+    s.trace.record(s)
+    metrics.observe(s)
+    if s.parent is None and TRACE_DIR:
+        export_trace(s.trace)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Open a child span of the current one, or a new trace when there is none."""
+    s = start_span(name, **attributes)
+    token = _current_span.set(s)
+    error = None
+    try:
+        yield s
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current_span.reset(token)
+        end_span(s, error)
+
+
+def traced(name):
+    """Decorator wrapping an async graph node in a span called `name`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Metrics:
+    """Span duration histograms and labelled counters in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}  # span name -> [bucket counts..., sum, count]
+        self.counters = {}  # (metric, labels tuple) -> value
+
+    def observe(self, s):
+        with self._lock:
+            h = self.durations.setdefault(s.name, [0] * len(DURATION_BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if s.duration <= bound:
+                    h[i] += 1
+            h[-2] += s.duration
+            h[-1] += 1
+            if s.status == "error":
+                self._inc("rag_span_errors_total", (("span", s.name),))
+            for key in ("input_tokens", "output_tokens"):
+                if key in s.attributes:
+                    self._inc("rag_llm_tokens_total", (("span", s.name), ("kind", key[:-7])), s.attributes[key])
+
+    def _inc(self, metric, labels, amount=1):
+        self.counters[(metric, labels)] = self.counters.get((metric, labels), 0) + amount
+
+    def inc(self, metric, amount=1, **labels):
+        with self._lock:
+            self._inc(metric, tuple(sorted(labels.items())), amount)
+
+    def render(self):
+        lines = ["# TYPE rag_span_duration_seconds histogram"]
+        with self._lock:
+            for name, h in sorted(self.durations.items()):
+                for bound, count in zip(DURATION_BUCKETS, h):
+                    lines.append(f'rag_span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+                lines.append(f'rag_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {h[-1]}')
+                lines.append(f'rag_span_duration_seconds_sum{{span="{name}"}} {h[-2]}')
+                lines.append(f'rag_span_duration_seconds_count{{span="{name}"}} {h[-1]}')
+            seen = set()
+            for (metric, labels), value in sorted(self.counters.items()):
+                if metric not in seen:
+                    seen.add(metric)
+                    lines.append(f"# TYPE {metric} counter")
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{metric}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def render_gauges(prefix, values):
+    """Render a flat dict of numbers as Prometheus gauges named `<prefix>_<key>`."""
+    lines = []
+    for key, value in values.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"# TYPE {prefix}_{key} gauge")
+            lines.append(f"{prefix}_{key} {value}")
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": value if isinstance(value, str) else json.dumps(value)}
+
+
+def export_trace(trace):
+    spans = [
+        {
+            "traceId": trace.trace_id,
+            "spanId": s.span_id,
+            "parentSpanId": s.parent.span_id if s.parent else "",
+            "name": s.name,
+            "startTimeUnixNano": str(s.start_ns),
+            "endTimeUnixNano": str(s.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items()],
+            "status": {"code": 2 if s.status == "error" else 1},
+        }
+        for s in trace.spans
+    ]
+    document = {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "ecolens-rag"}}]},
+            "scopeSpans": [{"scope": {"name": "base_rag"}, "spans": spans}],
+        }]
+    }
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    with open(os.path.join(TRACE_DIR, f"trace-{trace.trace_id}.json"), "w") as f:
+        json.dump(document, f)